@@ -0,0 +1,510 @@
+# usage: python emulator.py <Prog.hack | Prog.bin> [--cycles N]
+#                           [--break ADDRESS ...] [--ram FIRST:LAST]
+#                           [--restore State.snap] [--snapshot State.snap]
+#                           [--mmap] [--ram-image State.ram]
+#                           [--counters [Prog.asm] [--functions LABEL ...]]
+#   Runs a ROM image built by 06/assembler.py on a Python model of the
+#   Hack computer and prints the registers and a RAM range. --counters
+#   also prints RAM reads and writes, jumps taken, and with the program's
+#   .asm for its labels, calls and returns. Those are only found in VM
+#   translator output; in other programs --functions names the labels
+#   whose jumps count as calls.
+import argparse
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from enum import StrEnum
+from pathlib import Path
+
+from hackasm import assemble, readImage
+
+RAM_SIZE = 32768
+ADDRESS_MASK = 0x7FFF
+SCREEN = 16384
+KBD = 24576
+
+# Kinds of predecoded instructions
+A_INSTRUCTION = 0
+C_INSTRUCTION = 1
+HALT = 2
+BREAKPOINT = 3
+
+# Snapshot file: this header, then the RAM as little-endian words
+SNAPSHOT_MAGIC = b'HSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sHIhhHQ')
+
+
+class StopReason(StrEnum):
+    HALT = 'halt'
+    BREAKPOINT = 'breakpoint'
+    CYCLE_LIMIT = 'cycle limit'
+
+
+def wrap(value):
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+# ALU control bits zx nx zy ny f no -> out(D, y), y being A or M
+COMP_FUNCTIONS = {
+    0b101010: lambda d, y: 0,
+    0b111111: lambda d, y: 1,
+    0b111010: lambda d, y: -1,
+    0b001100: lambda d, y: d,
+    0b110000: lambda d, y: y,
+    0b001101: lambda d, y: ~d,
+    0b110001: lambda d, y: ~y,
+    0b001111: lambda d, y: wrap(-d),
+    0b110011: lambda d, y: wrap(-y),
+    0b011111: lambda d, y: wrap(d + 1),
+    0b110111: lambda d, y: wrap(y + 1),
+    0b001110: lambda d, y: wrap(d - 1),
+    0b110010: lambda d, y: wrap(y - 1),
+    0b000010: lambda d, y: wrap(d + y),
+    0b010011: lambda d, y: wrap(d - y),
+    0b000111: lambda d, y: wrap(y - d),
+    0b000000: lambda d, y: d & y,
+    0b010101: lambda d, y: d | y,
+}
+
+
+def aluFunction(control):
+    """
+    Any other control bits, computed the way the ALU chip does.
+    """
+    zx, nx, zy, ny, f, no = (bool(control >> (5 - i) & 1) for i in range(6))
+
+    def alu(d, y):
+        x = 0 if zx else d
+        x = ~x if nx else x
+        y = 0 if zy else y
+        y = ~y if ny else y
+        out = wrap(x + y) if f else x & y
+        return ~out if no else out
+    return alu
+
+
+# Name the VM translator gives the code outside functions and its shared
+# stubs
+WRAPPER_FUNCTION = 'Sys._wrapper'
+# Jump bits -> taken?, indexed by the sign of the ALU output (0, 1, -1)
+JUMP_CONDITIONS = [None] + [
+    (bool(j & 0b010), bool(j & 0b001), bool(j & 0b100)) for j in range(1, 8)
+]
+
+
+def isFunctionLabel(label):
+    """
+    Labels the VM translator writes for `function` commands have no '$'.
+    Its wrapper around code outside functions is never called.
+    """
+    return '$' not in label and label != WRAPPER_FUNCTION
+
+
+def functionOf(label):
+    """
+    Function whose code a label is in: the part before the '$'.
+    """
+    return label.partition('$')[0]
+
+
+def returnCaller(label):
+    """
+    Caller of a Caller$ret.N label, None for any other label.
+    """
+    caller, separator, suffix = label.rpartition('$ret.')
+    return caller if separator and suffix.isdecimal() else None
+
+
+def decode(word, romAddress, previousWord=None):
+    """
+    (A_INSTRUCTION, value) or
+    (C_INSTRUCTION, comp, readsM, writesA, writesD, writesM, jump).
+    `@N; 0;JMP` at ROM N is the usual end-of-program loop and becomes HALT.
+    """
+    if not word & 0x8000:
+        return (A_INSTRUCTION, word)
+
+    control = word >> 6 & 0b111111
+    jump = word & 0b111
+    if jump == 0b111 and not word & 0b111000 and previousWord is not None \
+            and not previousWord & 0x8000 and previousWord == romAddress - 1:
+        return (HALT,)
+    comp = COMP_FUNCTIONS.get(control) or aluFunction(control)
+    return (C_INSTRUCTION, comp, bool(word & 0x1000), bool(word & 0x20),
+            bool(word & 0x10), bool(word & 0x8), JUMP_CONDITIONS[jump])
+
+
+def mapRom(imageFilePath):
+    """
+    Read-only memory-mapped words of a .bin image, so processes running
+    the same image share its pages. A .hack image, or any image on a
+    big-endian host, is read with readImage() instead.
+    """
+    imageFilePath = Path(imageFilePath)
+    if imageFilePath.suffix == '.hack' or sys.byteorder == 'big':
+        return readImage(imageFilePath)
+    with imageFilePath.open(mode='rb') as src:
+        data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(data).cast('H')
+
+
+def mapRam(ramFilePath, keep=False):
+    """
+    RAM backed by a file of RAM_SIZE little-endian words, zeroed unless
+    keep asks to start from what the file already holds. Writes go
+    straight to the file, which holds the final RAM for whoever opens it
+    after the run.
+    """
+    if sys.byteorder == 'big':
+        raise ValueError('memory-mapped RAM needs a little-endian host')
+    ramFilePath = Path(ramFilePath)
+    if not keep or not ramFilePath.exists() or \
+            ramFilePath.stat().st_size != 2 * RAM_SIZE:
+        ramFilePath.write_bytes(bytes(2 * RAM_SIZE))
+    with ramFilePath.open(mode='r+b') as src:
+        data = mmap.mmap(src.fileno(), 0)
+    return memoryview(data).cast('h')
+
+
+class Emulator:
+    """
+    rom is any sequence of words, copied unless it is a memoryview such as
+    mapRom() returns. ram, when given, is used in place: any writable
+    buffer of RAM_SIZE signed 16-bit words, e.g. from mapRam().
+
+    Counters, RAM write hooks, watchpoints and a sampler are opt-in: while
+    none is set run() is the plain loop, once any is it switches to
+    runInstrumented().
+    """
+
+    def __init__(self, rom, ram=None):
+        self.rom = rom if isinstance(rom, memoryview) else array('H', rom)
+        self.program = [decode(word, i, self.rom[i-1] if i else None)
+                        for i, word in enumerate(self.rom)]
+        self.breakpoints = set()
+        if ram is None:
+            ram = array('h', bytes(2 * RAM_SIZE))
+        elif len(ram) != RAM_SIZE:
+            raise ValueError(f'RAM must have {RAM_SIZE} words')
+        self.ram = ram
+        self.clearHooks()
+        self.reset()
+
+    @classmethod
+    def load(cls, imageFilePath, ramFilePath=None, mapped=False):
+        """
+        mapped memory-maps a .bin image, ramFilePath backs RAM by a file.
+        """
+        rom = mapRom(imageFilePath) if mapped else readImage(imageFilePath)
+        return cls(rom, None if ramFilePath is None else mapRam(ramFilePath))
+
+    def flush(self):
+        """
+        Write memory-mapped RAM back to its file now.
+        """
+        if isinstance(self.ram, memoryview):
+            self.ram.obj.flush()
+
+    def reset(self):
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.cycles = 0
+
+    def romChecksum(self):
+        return zlib.crc32(self.rom.tobytes())
+
+    def snapshot(self):
+        """
+        RAM, registers and cycle count as bytes, see restore().
+        """
+        ram = self.ram
+        if sys.byteorder == 'big':
+            ram = array('h', ram)
+            ram.byteswap()
+        return SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.romChecksum(),
+            self.A, self.D, self.pc, self.cycles) + ram.tobytes()
+
+    def restore(self, data):
+        """
+        Back to the state of snapshot() data, any buffer such as bytes or
+        an mmap. The snapshot must come from the same ROM.
+        """
+        magic, version, checksum, a, d, pc, cycles = \
+            SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('not a snapshot of this format')
+        if checksum != self.romChecksum():
+            raise ValueError('snapshot was taken with another ROM')
+        ramBytes = memoryview(self.ram).cast('B')
+        ramBytes[:] = memoryview(data)[SNAPSHOT_HEADER.size:
+                                       SNAPSHOT_HEADER.size + len(ramBytes)]
+        if sys.byteorder == 'big':
+            self.ram.byteswap()
+        self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+
+    def saveSnapshot(self, snapshotFilePath):
+        Path(snapshotFilePath).write_bytes(self.snapshot())
+
+    def loadSnapshot(self, snapshotFilePath):
+        with Path(snapshotFilePath).open(mode='rb') as src, \
+                mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            self.restore(data)
+
+    def addBreakpoint(self, romAddress):
+        if romAddress not in self.breakpoints:
+            self.breakpoints.add(romAddress)
+            self.program[romAddress] = (BREAKPOINT, self.program[romAddress])
+
+    def removeBreakpoint(self, romAddress):
+        if romAddress in self.breakpoints:
+            self.breakpoints.remove(romAddress)
+            self.program[romAddress] = self.program[romAddress][1]
+
+    def clearHooks(self):
+        self.instrumented = False
+        self.counters = dict.fromkeys(
+            ('reads', 'writes', 'jumps', 'calls', 'returns'), 0)
+        self.callTargets = {}
+        self.writeHooks = []
+        self.watchedRam = None
+        self.watchpoints = {}
+        self.sampleInterval = None
+        self.sampler = None
+
+    def enableCounters(self, labels=None, functions=None):
+        """
+        Count RAM reads and writes and jumps taken into self.counters.
+        With the labels of a VM-translated program, i.e. one with
+        Caller$ret.N labels, jumps to its function labels and to the
+        Caller$ret.N labels also count as calls and returns. Other
+        programs, e.g. hand-written ones whose loop labels are no
+        functions, only count calls to the labels named in functions.
+        """
+        self.instrumented = True
+        labels = labels or {}
+        returns = [address for label, address in labels.items()
+                   if returnCaller(label) is not None]
+        if functions is None:
+            functions = [label for label in labels
+                         if isFunctionLabel(label)] if returns else []
+        for address in returns:
+            self.callTargets[address] = 'returns'
+        # The bootstrap's return address can be the entry of Sys.init
+        for label in functions:
+            self.callTargets[labels[label]] = 'calls'
+
+    def addWriteHook(self, first, last, hook):
+        """
+        hook(emulator, address, value) after every write to RAM[first:last].
+        """
+        self.instrumented = True
+        if self.watchedRam is None:
+            self.watchedRam = bytearray(RAM_SIZE)
+        self.watchedRam[first:last] = b'\1' * (last - first)
+        self.writeHooks.append((first, last, hook))
+
+    def addWatchpoint(self, romAddress, hook):
+        """
+        hook(emulator) each time execution reaches romAddress, before the
+        instruction there runs.
+        """
+        self.instrumented = True
+        self.watchpoints.setdefault(romAddress, []).append(hook)
+
+    def setSampler(self, interval, sampler):
+        """
+        sampler(emulator) every interval cycles.
+        """
+        self.instrumented = True
+        self.sampleInterval = interval
+        self.sampler = sampler
+
+    def step(self):
+        return self.run(1)
+
+    def run(self, maxCycles=None):
+        """
+        Execute until the program halts, reaches a breakpoint (stopping
+        before that instruction) or maxCycles instructions have run.
+        Running off the end of the program counts as halting.
+        """
+        if self.instrumented:
+            return self.runInstrumented(maxCycles)
+        program, ram = self.program, self.ram
+        a, d, pc = self.A, self.D, self.pc
+        start = cycles = self.cycles
+        limit = float('inf') if maxCycles is None else cycles + maxCycles
+        size = len(program)
+        reason = StopReason.CYCLE_LIMIT
+
+        while cycles < limit:
+            if pc >= size:
+                reason = StopReason.HALT
+                break
+            instruction = program[pc]
+            kind = instruction[0]
+            if kind == BREAKPOINT:
+                if cycles != start:
+                    reason = StopReason.BREAKPOINT
+                    break
+                instruction = instruction[1]
+                kind = instruction[0]
+
+            cycles += 1
+            if kind == A_INSTRUCTION:
+                a = instruction[1]
+                pc += 1
+            elif kind == C_INSTRUCTION:
+                _, comp, readsM, writesA, writesD, writesM, jump = instruction
+                address = a
+                out = comp(d, ram[address & ADDRESS_MASK] if readsM else a)
+                if writesM:
+                    ram[address & ADDRESS_MASK] = out
+                if writesA:
+                    a = out
+                if writesD:
+                    d = out
+                if jump is not None and jump[(out > 0) - (out < 0)]:
+                    pc = address & ADDRESS_MASK
+                else:
+                    pc += 1
+            else:
+                cycles -= 1
+                reason = StopReason.HALT
+                break
+
+        self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+        return reason
+
+    def runInstrumented(self, maxCycles=None):
+        """
+        run() with the counters, hooks, watchpoints and sampler. Hooks see
+        the registers up to date and may change them or RAM.
+        """
+        program, ram, counters = self.program, self.ram, self.counters
+        callTargets, watchpoints = self.callTargets, self.watchpoints
+        watchedRam, writeHooks = self.watchedRam, self.writeHooks
+        interval, sampler = self.sampleInterval, self.sampler
+        a, d, pc = self.A, self.D, self.pc
+        start = cycles = self.cycles
+        limit = float('inf') if maxCycles is None else cycles + maxCycles
+        nextSample = float('inf') if interval is None else \
+            (cycles // interval + 1) * interval
+        size = len(program)
+        reason = StopReason.CYCLE_LIMIT
+
+        while cycles < limit:
+            if pc >= size:
+                reason = StopReason.HALT
+                break
+            if pc in watchpoints:
+                self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+                for hook in watchpoints[pc]:
+                    hook(self)
+                a, d, pc = self.A, self.D, self.pc
+                if pc >= size:
+                    continue
+            instruction = program[pc]
+            kind = instruction[0]
+            if kind == BREAKPOINT:
+                if cycles != start:
+                    reason = StopReason.BREAKPOINT
+                    break
+                instruction = instruction[1]
+                kind = instruction[0]
+
+            cycles += 1
+            if kind == A_INSTRUCTION:
+                a = instruction[1]
+                pc += 1
+            elif kind == C_INSTRUCTION:
+                _, comp, readsM, writesA, writesD, writesM, jump = instruction
+                address = a & ADDRESS_MASK
+                if readsM:
+                    counters['reads'] += 1
+                    out = comp(d, ram[address])
+                else:
+                    out = comp(d, a)
+                if writesM:
+                    counters['writes'] += 1
+                    ram[address] = out
+                if writesA:
+                    a = out
+                if writesD:
+                    d = out
+                if jump is not None and jump[(out > 0) - (out < 0)]:
+                    pc = address
+                    counters['jumps'] += 1
+                    if pc in callTargets:
+                        counters[callTargets[pc]] += 1
+                else:
+                    pc += 1
+                if writesM and watchedRam is not None and watchedRam[address]:
+                    self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+                    for first, last, hook in writeHooks:
+                        if first <= address < last:
+                            hook(self, address, out)
+                    a, d, pc = self.A, self.D, self.pc
+            else:
+                cycles -= 1
+                reason = StopReason.HALT
+                break
+
+            if cycles >= nextSample:
+                self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+                sampler(self)
+                a, d, pc = self.A, self.D, self.pc
+                nextSample += interval
+
+        self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+        return reason
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Run a Hack ROM image.')
+    argParser.add_argument('image')
+    argParser.add_argument('--cycles', type=int, default=None)
+    argParser.add_argument('--break', dest='breakpoints', type=int,
+                           nargs='*', default=[])
+    argParser.add_argument('--ram', default='0:16',
+                           help='RAM range to print, FIRST:LAST exclusive')
+    argParser.add_argument('--restore', help='start from this snapshot')
+    argParser.add_argument('--snapshot', help='save the final state here')
+    argParser.add_argument('--mmap', action='store_true',
+                           help='memory-map a .bin image instead of reading it')
+    argParser.add_argument('--ram-image',
+                           help='keep RAM in this file, 64 KiB of words')
+    argParser.add_argument('--counters', nargs='?', const='', default=None,
+                           metavar='PROG.ASM')
+    argParser.add_argument('--functions', nargs='*', default=None,
+                           metavar='LABEL',
+                           help='count calls to these labels of PROG.ASM')
+    args = argParser.parse_args()
+
+    emulator = Emulator.load(args.image, args.ram_image, args.mmap)
+    if args.counters is not None:
+        labels = None
+        if args.counters:
+            labels = assemble(args.counters)[1]
+        emulator.enableCounters(labels, args.functions)
+    if args.restore:
+        emulator.loadSnapshot(args.restore)
+    for romAddress in args.breakpoints:
+        emulator.addBreakpoint(romAddress)
+    reason = emulator.run(args.cycles)
+    if args.snapshot:
+        emulator.saveSnapshot(args.snapshot)
+    emulator.flush()
+
+    first, last = (int(n) for n in args.ram.split(':'))
+    print(f'{reason} after {emulator.cycles} cycles: '
+          f'PC={emulator.pc} A={emulator.A} D={emulator.D}')
+    for address in range(first, last):
+        print(f'RAM[{address}] = {emulator.ram[address]}')
+    if args.counters is not None:
+        print(', '.join(f'{n} {name}' for name, n in emulator.counters.items()))
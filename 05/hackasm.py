@@ -0,0 +1,44 @@
+"""
+The assembler from 06, for the tools in this folder and 08/vm2hack.py.
+Project folders reuse module names (06 and 08 both have parser.py), so the
+assembler's modules are imported in isolation and never left in
+sys.modules, and a process can use 05 and 08 together.
+"""
+import importlib
+import sys
+from pathlib import Path
+
+AssemblerFolder = Path(__file__).resolve().parent.parent.joinpath('06')
+
+
+def importFrom(folder, name):
+    """
+    Import name from folder, whose modules only shadow ours while the
+    import is bound.
+    """
+    local = {p.stem for p in folder.glob('*.py')}
+    shadowed = {n: sys.modules.pop(n) for n in local if n in sys.modules}
+    sys.path.insert(0, str(folder))
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(str(folder))
+        for n in local:
+            sys.modules.pop(n, None)
+        sys.modules.update(shadowed)
+
+
+assembler = importFrom(AssemblerFolder, 'assembler')
+StreamAssembler = assembler.StreamAssembler
+readImage = assembler.readImage
+
+
+def assemble(asmFilePath):
+    """
+    (ROM words, labels) of an assembly file.
+    """
+    stream = StreamAssembler()
+    with Path(asmFilePath).open() as src:
+        stream.feed(src)
+    words = stream.finish()
+    return words, stream.labels
@@ -0,0 +1,202 @@
+# usage: python jit.py <Prog.hack | Prog.bin> [--cycles N] [--ram FIRST:LAST]
+#                      [--restore State.snap] [--snapshot State.snap]
+#                      [--mmap] [--ram-image State.ram]
+#   Same as emulator.py, but runs each basic block as one generated
+#   Python function.
+import argparse
+
+from emulator import (ADDRESS_MASK, BREAKPOINT, HALT, Emulator, StopReason,
+                      aluFunction)
+
+
+def wrapped(expression):
+    return f'((({expression}) + 32768) & 65535) - 32768'
+
+
+# ALU control bits -> Python expression over d and y
+COMP_EXPRESSIONS = {
+    0b101010: '0',
+    0b111111: '1',
+    0b111010: '-1',
+    0b001100: 'd',
+    0b110000: '{y}',
+    0b001101: '~d',
+    0b110001: '~{y}',
+    0b001111: wrapped('-d'),
+    0b110011: wrapped('-{y}'),
+    0b011111: wrapped('d + 1'),
+    0b110111: wrapped('{y} + 1'),
+    0b001110: wrapped('d - 1'),
+    0b110010: wrapped('{y} - 1'),
+    0b000010: wrapped('d + {y}'),
+    0b010011: wrapped('d - {y}'),
+    0b000111: wrapped('{y} - d'),
+    0b000000: 'd & {y}',
+    0b010101: 'd | {y}',
+}
+JUMP_EXPRESSIONS = [None, 'out > 0', 'out == 0', 'out >= 0',
+                    'out < 0', 'out != 0', 'out <= 0', 'True']
+
+
+class JitEmulator(Emulator):
+    """
+    Splits the ROM into basic blocks, after jumps and at jump targets
+    (labels loaded right before a jump), and compiles each block on first
+    entry into a function (ram, a, d) -> (pc, a, d). Blocks are cached by
+    entry address; a computed jump elsewhere, e.g. to a return address,
+    just compiles a block from there.
+    """
+
+    def __init__(self, rom, ram=None):
+        super().__init__(rom, ram)
+        self.leaders = {0}
+        previousWord = None
+        for romAddress, word in enumerate(self.rom):
+            if word & 0x8000 and word & 0b111:
+                self.leaders.add(romAddress + 1)
+                if previousWord is not None and not previousWord & 0x8000:
+                    self.leaders.add(previousWord)
+            previousWord = word
+        self.blocks = {}
+
+    def addBreakpoint(self, romAddress):
+        super().addBreakpoint(romAddress)
+        self.blocks.clear()
+
+    def removeBreakpoint(self, romAddress):
+        super().removeBreakpoint(romAddress)
+        self.blocks.clear()
+
+    def kind(self, romAddress):
+        instruction = self.program[romAddress]
+        if instruction[0] == BREAKPOINT:
+            instruction = instruction[1]
+        return instruction[0]
+
+    def compileBlock(self, entry):
+        """
+        Returns (function, instruction count). Within the block A is
+        tracked as a constant where possible, so '@SP; AM=M-1' indexes
+        ram[0] directly.
+        """
+        namespace = {}
+        body = []
+        a = None
+        romAddress = entry
+        size = len(self.rom)
+        exitPc = None
+
+        def aValue():
+            return 'a' if a is None else str(a)
+
+        def address():
+            return f'a & {ADDRESS_MASK}' if a is None else str(a)
+
+        while romAddress < size:
+            if romAddress != entry and (romAddress in self.leaders or
+                                        romAddress in self.breakpoints):
+                break
+            word = self.rom[romAddress]
+            if self.kind(romAddress) == HALT:
+                break
+            romAddress += 1
+
+            if not word & 0x8000:
+                a = word
+                continue
+
+            control = word >> 6 & 0b111111
+            y = f'ram[{address()}]' if word & 0x1000 else aValue()
+            if control in COMP_EXPRESSIONS:
+                comp = COMP_EXPRESSIONS[control].format(y=y)
+            else:
+                namespace[f'alu{control}'] = aluFunction(control)
+                comp = f'alu{control}(d, {y})'
+
+            jump = JUMP_EXPRESSIONS[word & 0b111]
+            target = address()
+            body.append(f'out = {comp}')
+            if word & 0x8:
+                body.append(f'ram[{address()}] = out')
+            if jump is not None and a is None:
+                body.append(f'target = {target}')
+                target = 'target'
+            if word & 0x20:
+                a = None
+                body.append('a = out')
+            if word & 0x10:
+                body.append('d = out')
+            if jump is not None:
+                body.append(f'if {jump}:')
+                body.append(f'    return {target}, {aValue()}, d')
+                exitPc = romAddress
+                break
+
+        if exitPc is None:
+            exitPc = romAddress
+        body.append(f'return {exitPc}, {aValue()}, d')
+
+        source = 'def block(ram, a, d):\n' + \
+            ''.join(f'    {line}\n' for line in body)
+        exec(compile(source, f'<hack block {entry}>', 'exec'), namespace)
+        return namespace['block'], romAddress - entry
+
+    def run(self, maxCycles=None):
+        if self.instrumented:
+            return self.runInstrumented(maxCycles)
+        ram, blocks = self.ram, self.blocks
+        a, d, pc = self.A, self.D, self.pc
+        start = cycles = self.cycles
+        limit = float('inf') if maxCycles is None else cycles + maxCycles
+        size = len(self.program)
+        reason = None
+
+        while reason is None:
+            if pc >= size or self.kind(pc) == HALT:
+                reason = StopReason.HALT
+                break
+            if pc in self.breakpoints and cycles != start:
+                reason = StopReason.BREAKPOINT
+                break
+            block = blocks.get(pc)
+            if block is None:
+                block = blocks[pc] = self.compileBlock(pc)
+            function, count = block
+            if cycles + count > limit:
+                # The block would overshoot, finish instruction by instruction
+                self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+                return super().run(limit - cycles)
+            pc, a, d = function(ram, a, d)
+            cycles += count
+
+        self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+        return reason
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Run a Hack ROM image.')
+    argParser.add_argument('image')
+    argParser.add_argument('--cycles', type=int, default=None)
+    argParser.add_argument('--ram', default='0:16',
+                           help='RAM range to print, FIRST:LAST exclusive')
+    argParser.add_argument('--restore', help='start from this snapshot')
+    argParser.add_argument('--snapshot', help='save the final state here')
+    argParser.add_argument('--mmap', action='store_true',
+                           help='memory-map a .bin image instead of reading it')
+    argParser.add_argument('--ram-image',
+                           help='keep RAM in this file, 64 KiB of words')
+    args = argParser.parse_args()
+
+    emulator = JitEmulator.load(args.image, args.ram_image, args.mmap)
+    if args.restore:
+        emulator.loadSnapshot(args.restore)
+    reason = emulator.run(args.cycles)
+    if args.snapshot:
+        emulator.saveSnapshot(args.snapshot)
+    emulator.flush()
+
+    first, last = (int(n) for n in args.ram.split(':'))
+    print(f'{reason} after {emulator.cycles} cycles: '
+          f'PC={emulator.pc} A={emulator.A} D={emulator.D}')
+    for address in range(first, last):
+        print(f'RAM[{address}] = {emulator.ram[address]}')
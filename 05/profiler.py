@@ -0,0 +1,305 @@
+# usage: python profiler.py <Prog.asm | Prog.hack | Prog.bin> [--asm Prog.asm]
+#                           [--cycles N] [--top N] [--by-label]
+#                           [--collapsed Prog.folded]
+#   Runs a program on emulator.py counting the cycles spent at every ROM
+#   address, and prints them rolled up to functions: a flat profile and
+#   call-graph edges. Functions are the labels the VM translator writes
+#   for `function` commands, calls and returns are recognised by jumps to
+#   them and to the Caller$ret.N labels. --collapsed writes stacks in the
+#   format flamegraph.pl and speedscope read. Programs without Caller$ret.N
+#   labels, e.g. from other translators, only get the flat profile.
+import argparse
+from array import array
+from pathlib import Path
+
+from emulator import (A_INSTRUCTION, ADDRESS_MASK, BREAKPOINT, C_INSTRUCTION,
+                      Emulator, StopReason, functionOf, isFunctionLabel,
+                      returnCaller)
+from hackasm import assemble, readImage
+
+START = '<start>'
+# A called function finds its return address in the frame below LCL
+LCL = 1
+RETURN_ADDRESS_OFFSET = 5
+# Hack frames take at least 5 words of a stack below 2K words, so a deeper
+# shadow stack means calls and returns were not matched
+MAX_DEPTH = 512
+
+
+def ownerTable(size, labels, name=lambda label: label):
+    """
+    name() of the last label at or before every ROM address.
+    """
+    owners = [START] * size
+    starts = sorted((address, name(label)) for label, address in labels.items()
+                    if address < size)
+    for i, (address, label) in enumerate(starts):
+        end = starts[i+1][0] if i + 1 < len(starts) else size
+        owners[address:end] = [label] * (end - address)
+    return owners
+
+
+class Profiler(Emulator):
+    """
+    Emulator counting cycles per ROM address, and keeping a shadow call
+    stack for the call graph and the collapsed stacks. Every frame keeps
+    the return address its call left on the Hack stack, so a return pops
+    exactly the frames above its own, recursive ones included. Stacks are
+    kept as ids of (parent id, function) frames, named only when written
+    out.
+    """
+
+    def __init__(self, rom, labels=None):
+        super().__init__(rom)
+        self.labels = {} if labels is None else labels
+        self.counts = array('Q', bytes(8 * len(self.rom)))
+        self.returns = {address: returnCaller(label)
+                        for label, address in self.labels.items()
+                        if returnCaller(label) is not None}
+        # Without return labels calls could never be matched
+        self.tracking = bool(self.returns)
+        self.entries = {address: label for label, address in self.labels.items()
+                        if isFunctionLabel(label)} if self.tracking else {}
+        self.frames = [(None, START)]
+        self.frameIds = {(None, START): 0}
+        self.stack = [START]
+        self.stackIds = [0]
+        self.returnAddresses = []
+        self.resets = 0
+        self.stackCycles = 0
+        self.calls = {}
+        self.edges = {}
+        self.inclusive = {}
+        self.collapsed = {}
+        self.entryCycles = []
+
+    def frameId(self, parent, function):
+        key = (parent, function)
+        frameId = self.frameIds.get(key)
+        if frameId is None:
+            frameId = self.frameIds[key] = len(self.frames)
+            self.frames.append(key)
+        return frameId
+
+    def resetStack(self, function, cycles):
+        """
+        Restart the shadow stack at function, when it lost track.
+        """
+        self.switchStack(cycles)
+        self.stack = [function]
+        self.stackIds = [self.frameId(None, function)]
+        self.entryCycles = []
+        self.returnAddresses = []
+        self.resets += 1
+
+    def enter(self, function, returnAddress, cycles):
+        caller = self.stack[-1]
+        if len(self.stack) >= MAX_DEPTH:
+            self.resetStack(caller, cycles)
+        self.switchStack(cycles)
+        self.calls[function] = self.calls.get(function, 0) + 1
+        edge = self.edges.setdefault((caller, function), [0, 0])
+        edge[0] += 1
+        self.stack.append(function)
+        self.stackIds.append(self.frameId(self.stackIds[-1], function))
+        self.entryCycles.append(cycles)
+        self.returnAddresses.append(returnAddress)
+
+    def leave(self, returnAddress, caller, cycles):
+        if returnAddress not in self.returnAddresses:
+            # Returned to a frame entered before profiling began
+            self.resetStack(caller, cycles)
+            return
+        self.switchStack(cycles)
+        # Frames above the returning one never returned, e.g. after a
+        # reset of the Hack stack
+        while True:
+            function = self.stack.pop()
+            self.stackIds.pop()
+            spent = cycles - self.entryCycles.pop()
+            # Recursive activations are already inside the outermost one
+            edge = (self.stack[-1], function)
+            if edge not in zip(self.stack, self.stack[1:]):
+                self.edges[edge][1] += spent
+            if function not in self.stack:
+                self.inclusive[function] = \
+                    self.inclusive.get(function, 0) + spent
+            if self.returnAddresses.pop() == returnAddress:
+                break
+
+    def switchStack(self, cycles):
+        key = self.stackIds[-1]
+        self.collapsed[key] = \
+            self.collapsed.get(key, 0) + cycles - self.stackCycles
+        self.stackCycles = cycles
+
+    def finishStack(self):
+        """
+        Attribute the cycles since the last call or return, e.g. after a
+        run that stopped inside a function.
+        """
+        self.switchStack(self.cycles)
+
+    def run(self, maxCycles=None):
+        """
+        Emulator.run, also counting every executed address and tracking
+        jumps to function entries and return addresses.
+        """
+        program, ram, counts = self.program, self.ram, self.counts
+        entries, returns = self.entries, self.returns
+        a, d, pc = self.A, self.D, self.pc
+        start = cycles = self.cycles
+        limit = float('inf') if maxCycles is None else cycles + maxCycles
+        size = len(program)
+        reason = StopReason.CYCLE_LIMIT
+
+        while cycles < limit:
+            if pc >= size:
+                reason = StopReason.HALT
+                break
+            instruction = program[pc]
+            kind = instruction[0]
+            if kind == BREAKPOINT:
+                if cycles != start:
+                    reason = StopReason.BREAKPOINT
+                    break
+                instruction = instruction[1]
+                kind = instruction[0]
+
+            counts[pc] += 1
+            cycles += 1
+            if kind == A_INSTRUCTION:
+                a = instruction[1]
+                pc += 1
+            elif kind == C_INSTRUCTION:
+                _, comp, readsM, writesA, writesD, writesM, jump = instruction
+                address = a
+                out = comp(d, ram[address & ADDRESS_MASK] if readsM else a)
+                if writesM:
+                    ram[address & ADDRESS_MASK] = out
+                if writesA:
+                    a = out
+                if writesD:
+                    d = out
+                if jump is not None and jump[(out > 0) - (out < 0)]:
+                    pc = address & ADDRESS_MASK
+                    if pc in entries:
+                        self.enter(entries[pc], ram[
+                            (ram[LCL] - RETURN_ADDRESS_OFFSET) & ADDRESS_MASK],
+                            cycles)
+                    elif pc in returns:
+                        self.leave(pc, returns[pc], cycles)
+                else:
+                    pc += 1
+            else:
+                counts[pc] -= 1
+                cycles -= 1
+                reason = StopReason.HALT
+                break
+
+        self.A, self.D, self.pc, self.cycles = a, d, pc, cycles
+        return reason
+
+    def totalCycles(self):
+        """
+        Inclusive cycles per function, counting the frames still active.
+        """
+        totals = dict(self.inclusive)
+        totals[self.stack[0]] = self.cycles
+        active = set()
+        for function, entry in zip(self.stack[1:], self.entryCycles):
+            if function not in active:
+                active.add(function)
+                totals[function] = totals.get(function, 0) + self.cycles - entry
+        return totals
+
+    def selfCycles(self, byLabel=False):
+        """
+        Cycles per function, or per label of any kind, in the code it owns.
+        """
+        name = (lambda label: label) if byLabel else functionOf
+        owners = ownerTable(len(self.rom), self.labels, name)
+        totals = {}
+        for address, count in enumerate(self.counts):
+            if count:
+                totals[owners[address]] = totals.get(owners[address], 0) + count
+        return totals
+
+    def printFlat(self, top=None, byLabel=False):
+        totals = self.selfCycles(byLabel)
+        inclusive = self.totalCycles()
+        cycles = max(self.cycles, 1)
+        print(f'{"self":>12} {"self%":>6} {"total":>12} {"calls":>9}  '
+              f'{"label" if byLabel else "function"}')
+        ranked = sorted(totals.items(), key=lambda item: -item[1])
+        for name, count in ranked[:top]:
+            print(f'{count:12} {100 * count / cycles:6.2f} '
+                  f'{inclusive.get(name, ""):>12} '
+                  f'{self.calls.get(name, ""):>9}  {name}')
+
+    def printCallGraph(self, top=None):
+        print(f'{"calls":>9} {"cycles":>12}  caller -> callee')
+        ranked = sorted(self.edges.items(), key=lambda item: -item[1][1])
+        for (caller, callee), (calls, cycles) in ranked[:top]:
+            print(f'{calls:9} {cycles:12}  {caller} -> {callee}')
+
+    def collapsedStacks(self):
+        """
+        Cycles per stack, named caller;callee;...
+        """
+        names = []
+        # Parents always come before their children
+        for parent, function in self.frames:
+            names.append(function if parent is None
+                         else f'{names[parent]};{function}')
+        return {names[frameId]: cycles
+                for frameId, cycles in self.collapsed.items() if cycles}
+
+    def writeCollapsed(self, destFilePath):
+        with Path(destFilePath).open(mode='w', encoding='utf-8') as dest:
+            for stack, cycles in sorted(self.collapsedStacks().items()):
+                dest.write(f'{stack} {cycles}\n')
+
+
+def loadProgram(programFilePath, asmFilePath=None):
+    """
+    (ROM words, labels). Labels of a .hack or .bin image come from the
+    .asm next to it, when there is one.
+    """
+    programFilePath = Path(programFilePath)
+    if programFilePath.suffix == '.asm':
+        return assemble(programFilePath)
+    if asmFilePath is None:
+        asmFilePath = programFilePath.with_suffix('.asm')
+        if not asmFilePath.exists():
+            return readImage(programFilePath), {}
+    return readImage(programFilePath), assemble(asmFilePath)[1]
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Profile a Hack program.')
+    argParser.add_argument('program')
+    argParser.add_argument('--asm', help='labels for a .hack or .bin image')
+    argParser.add_argument('--cycles', type=int, default=None)
+    argParser.add_argument('--top', type=int, default=30)
+    argParser.add_argument('--by-label', action='store_true',
+                           help='roll the flat profile up to every label')
+    argParser.add_argument('--collapsed',
+                           help='write collapsed stacks for flame graphs')
+    args = argParser.parse_args()
+
+    profiler = Profiler(*loadProgram(args.program, args.asm))
+    reason = profiler.run(args.cycles)
+    profiler.finishStack()
+
+    print(f'{reason} after {profiler.cycles} cycles\n')
+    profiler.printFlat(args.top, args.by_label)
+    print()
+    if not profiler.tracking:
+        print('no Caller$ret.N labels, calls are not tracked')
+    else:
+        profiler.printCallGraph(args.top)
+        if profiler.resets:
+            print(f'\nlost track of the call stack {profiler.resets} times')
+    if args.collapsed:
+        profiler.writeCollapsed(args.collapsed)
@@ -0,0 +1,172 @@
+# usage: python replay.py <Prog.hack | Prog.bin> <session.keys> ...
+#                         [--cycles N] [--jit] [--jobs N] [--screen]
+#                         [--snapshot] [--restore State.snap]
+#                         [--mmap] [--ram-image]
+#   Runs a program headless once per key trace, pressing and releasing
+#   keys (RAM[24576]) at the recorded cycles, and prints the final state of
+#   every run with a CRC of the screen for regression checks. --screen,
+#   --snapshot and --ram-image save session.png, session.snap and the
+#   memory-mapped RAM session.ram next to each trace.
+#
+#   A trace has one event per line, `CYCLE KEY`, KEY being a Hack key
+#   code, a key name (LEFT, SPACE, ...), a single non-digit character, or
+#   0 / NONE for releasing the key. Text after // is a comment.
+import argparse
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from emulator import KBD, SCREEN, Emulator, StopReason
+from jit import JitEmulator
+from screen import ScreenRenderer
+
+# Cycles to keep running after the last event when no limit is given
+SETTLE_CYCLES = 1000000
+KEY_CODES = {
+    'NONE': 0, 'SPACE': 32, 'NEWLINE': 128, 'ENTER': 128, 'BACKSPACE': 129,
+    'LEFT': 130, 'UP': 131, 'RIGHT': 132, 'DOWN': 133, 'HOME': 134,
+    'END': 135, 'PAGEUP': 136, 'PAGEDOWN': 137, 'INSERT': 138,
+    'DELETE': 139, 'ESC': 140,
+    **{f'F{i}': 140 + i for i in range(1, 13)},
+}
+
+
+def keyCode(key):
+    if key.isdecimal():
+        return int(key)
+    if key.upper() in KEY_CODES:
+        return KEY_CODES[key.upper()]
+    if len(key) == 1:
+        return ord(key)
+    raise ValueError(f'unknown key {key}')
+
+
+def readTrace(traceFilePath):
+    """
+    Sorted (cycle, key code) events of a trace file.
+    """
+    events = []
+    with Path(traceFilePath).open() as src:
+        for lineNumber, line in enumerate(src, 1):
+            line = line.split('//')[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if len(fields) != 2 or not fields[0].isdecimal():
+                raise ValueError(f'{traceFilePath}:{lineNumber}: '
+                                 f'expected CYCLE KEY')
+            events.append((int(fields[0]), keyCode(fields[1])))
+    return sorted(events, key=lambda event: event[0])
+
+
+def replay(emulator, events, maxCycles=None):
+    """
+    Run, setting the keyboard register whenever the cycle count reaches an
+    event. Without maxCycles the run goes on for SETTLE_CYCLES after the
+    last event. Stops early when the program halts.
+    """
+    ram = emulator.ram
+    if maxCycles is None:
+        maxCycles = (events[-1][0] if events else 0) + SETTLE_CYCLES
+    reason = StopReason.CYCLE_LIMIT
+    for cycle, code in events:
+        if cycle >= maxCycles:
+            break
+        if cycle > emulator.cycles:
+            reason = emulator.run(cycle - emulator.cycles)
+            if reason != StopReason.CYCLE_LIMIT:
+                return reason
+        ram[KBD] = code
+    if maxCycles > emulator.cycles:
+        reason = emulator.run(maxCycles - emulator.cycles)
+    return reason
+
+
+def screenChecksum(emulator):
+    return zlib.crc32(emulator.ram[SCREEN:KBD].tobytes())
+
+
+def replayFile(imageFilePath, traceFilePath, maxCycles=None, jit=False,
+               screen=False, snapshot=False, restore=None, mapped=False,
+               ramImage=False):
+    """
+    Batch worker, returns (trace, reason, cycles, seconds, screen CRC,
+    error) instead of raising.
+    """
+    start = time.perf_counter()
+    try:
+        ramFilePath = Path(traceFilePath).with_suffix('.ram') \
+            if ramImage else None
+        emulator = (JitEmulator if jit else Emulator).load(
+            imageFilePath, ramFilePath, mapped)
+        if restore is not None:
+            emulator.loadSnapshot(restore)
+        reason = replay(emulator, readTrace(traceFilePath), maxCycles)
+        if screen:
+            renderer = ScreenRenderer(emulator.ram)
+            renderer.render()
+            renderer.save(Path(traceFilePath).with_suffix('.png'))
+        if snapshot:
+            emulator.saveSnapshot(Path(traceFilePath).with_suffix('.snap'))
+        emulator.flush()
+    except Exception as e:
+        return (traceFilePath, None, None, time.perf_counter() - start, None,
+                f'{type(e).__name__}: {e}')
+    return (traceFilePath, reason, emulator.cycles,
+            time.perf_counter() - start, screenChecksum(emulator), None)
+
+
+def replayBatch(imageFilePath, traceFilePaths, workers=None, **options):
+    """
+    Replay every trace across a process pool, results in trace order.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(replayFile, imageFilePath, trace, **options)
+                   for trace in traceFilePaths]
+        for future in as_completed(futures):
+            results.append(future.result())
+    return sorted(results, key=lambda result: str(result[0]))
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Replay key traces.')
+    argParser.add_argument('image')
+    argParser.add_argument('traces', nargs='+')
+    argParser.add_argument('--cycles', type=int, default=None,
+                           help=f'total cycles per run, default the last '
+                           f'event + {SETTLE_CYCLES}')
+    argParser.add_argument('--jit', action='store_true')
+    argParser.add_argument('--jobs', type=int, default=None)
+    argParser.add_argument('--screen', action='store_true',
+                           help='save the final screen next to each trace')
+    argParser.add_argument('--snapshot', action='store_true',
+                           help='save the final state next to each trace')
+    argParser.add_argument('--restore', help='start every run from this '
+                           'snapshot, e.g. one taken after the OS booted')
+    argParser.add_argument('--mmap', action='store_true',
+                           help='share a .bin image between the workers')
+    argParser.add_argument('--ram-image', action='store_true',
+                           help='keep each run\'s RAM in a file next to the '
+                           'trace')
+    args = argParser.parse_args()
+    options = dict(maxCycles=args.cycles, jit=args.jit, screen=args.screen,
+                   snapshot=args.snapshot, restore=args.restore,
+                   mapped=args.mmap, ramImage=args.ram_image)
+
+    if len(args.traces) == 1:
+        results = [replayFile(args.image, args.traces[0], **options)]
+    else:
+        results = replayBatch(args.image, args.traces, args.jobs, **options)
+
+    failed = 0
+    for trace, reason, cycles, seconds, checksum, error in results:
+        if error is not None:
+            failed += 1
+            print(f'{seconds * 1000:10.1f} ms  {trace}  FAILED: {error}')
+        else:
+            print(f'{seconds * 1000:10.1f} ms  {trace}  {reason} after '
+                  f'{cycles} cycles, screen crc {checksum:08x}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,160 @@
+# usage: python screen.py <Prog.hack | Prog.bin> [--cycles N] [--every N]
+#                         [--out frame.png | frame.ppm] [--jit]
+#   Runs a program and writes the Hack screen as an image: once at the
+#   end, or after every N cycles as frame-0001.png, frame-0002.png, ...
+#   skipping frames where the screen did not change.
+#   Uses NumPy when it is installed, plain byte tables otherwise.
+import argparse
+import struct
+import sys
+import zlib
+from pathlib import Path
+
+from emulator import KBD, SCREEN, Emulator, StopReason
+from jit import JitEmulator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WIDTH = 512
+HEIGHT = 256
+SCREEN_WORDS = KBD - SCREEN
+WHITE = 255
+BLACK = 0
+
+
+def buildPixelTable():
+    """
+    Grey levels of the 8 pixels of every byte, the lowest bit leftmost.
+    """
+    return [bytes(BLACK if byte >> bit & 1 else WHITE for bit in range(8))
+            for byte in range(256)]
+
+
+PIXELS = buildPixelTable()
+
+
+class ScreenRenderer:
+    """
+    Keeps an 8-bit greyscale frame of RAM[16384..24575], one byte per
+    pixel, and re-renders only the words that changed since the last
+    render(). ram is the emulator's array('h') (or any buffer of 16-bit
+    words) and is read in place, never copied.
+    """
+
+    def __init__(self, ram):
+        if np is not None:
+            self.words = np.frombuffer(ram, dtype=np.int16,
+                                       count=SCREEN_WORDS, offset=2 * SCREEN)
+            self.previous = np.zeros(SCREEN_WORDS, dtype=np.int16)
+            self.frame = np.full((HEIGHT, WIDTH), WHITE, dtype=np.uint8)
+        else:
+            self.words = memoryview(ram)[SCREEN:KBD]
+            self.previous = bytearray(2 * SCREEN_WORDS)
+            self.frame = bytearray([WHITE]) * (WIDTH * HEIGHT)
+
+    def render(self):
+        """
+        Bring the frame up to date, returns the number of changed words.
+        """
+        if np is not None:
+            return self.renderArray()
+        current = self.words.tobytes()
+        previous = self.previous
+        if current == previous:
+            return 0
+        frame = self.frame
+        dirty = 0
+        for i in range(0, 2 * SCREEN_WORDS, 2):
+            low, high = current[i], current[i+1]
+            if low != previous[i] or high != previous[i+1]:
+                # Words are stored in machine order
+                if sys.byteorder == 'big':
+                    low, high = high, low
+                frame[8*i:8*i+8] = PIXELS[low]
+                frame[8*i+8:8*i+16] = PIXELS[high]
+                dirty += 1
+        self.previous = bytearray(current)
+        return dirty
+
+    def renderArray(self):
+        dirty = np.flatnonzero(self.words != self.previous)
+        if dirty.size:
+            changed = self.words[dirty]
+            bits = np.unpackbits(changed.astype('<u2').view(np.uint8),
+                                 bitorder='little').reshape(-1, 16)
+            self.frame.reshape(-1, 16)[dirty] = \
+                np.where(bits, BLACK, WHITE).astype(np.uint8)
+            self.previous[dirty] = changed
+        return int(dirty.size)
+
+    def pixels(self):
+        """
+        The frame as bytes, row after row.
+        """
+        return self.frame.tobytes() if np is not None else bytes(self.frame)
+
+    def savePpm(self, destFilePath):
+        with Path(destFilePath).open(mode='wb') as dest:
+            dest.write(f'P5\n{WIDTH} {HEIGHT}\n255\n'.encode())
+            dest.write(self.pixels())
+
+    def savePng(self, destFilePath):
+        pixels = self.pixels()
+        # Every row starts with filter type 0
+        rows = b''.join(b'\0' + pixels[y*WIDTH:(y+1)*WIDTH]
+                        for y in range(HEIGHT))
+
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + \
+                struct.pack('>I', zlib.crc32(kind + data))
+
+        with Path(destFilePath).open(mode='wb') as dest:
+            dest.write(b'\x89PNG\r\n\x1a\n')
+            dest.write(chunk(b'IHDR', struct.pack('>IIBBBBB', WIDTH, HEIGHT,
+                                                  8, 0, 0, 0, 0)))
+            dest.write(chunk(b'IDAT', zlib.compress(rows)))
+            dest.write(chunk(b'IEND', b''))
+
+    def save(self, destFilePath):
+        if Path(destFilePath).suffix == '.ppm':
+            self.savePpm(destFilePath)
+        else:
+            self.savePng(destFilePath)
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Capture the Hack screen.')
+    argParser.add_argument('image')
+    argParser.add_argument('--cycles', type=int, default=None)
+    argParser.add_argument('--every', type=int, default=None,
+                           help='write a numbered frame every N cycles')
+    argParser.add_argument('--out', default='screen.png')
+    argParser.add_argument('--jit', action='store_true')
+    args = argParser.parse_args()
+
+    emulator = (JitEmulator if args.jit else Emulator).load(args.image)
+    renderer = ScreenRenderer(emulator.ram)
+    out = Path(args.out)
+
+    if args.every is None:
+        reason = emulator.run(args.cycles)
+        renderer.render()
+        renderer.save(out)
+    else:
+        frame = 0
+        while True:
+            remaining = None if args.cycles is None else \
+                args.cycles - emulator.cycles
+            if remaining is not None and remaining <= 0:
+                break
+            reason = emulator.run(args.every if remaining is None
+                                  else min(args.every, remaining))
+            frame += 1
+            if renderer.render() or frame == 1:
+                renderer.save(out.with_stem(f'{out.stem}-{frame:04}'))
+            if reason != StopReason.CYCLE_LIMIT:
+                break
+    print(f'{reason} after {emulator.cycles} cycles')
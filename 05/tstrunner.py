@@ -0,0 +1,506 @@
+# usage: python tstrunner.py <Test.tst | folder> ... [--jit] [--no-out]
+#   Runs nand2tetris test scripts without the Java tools: CPU.hdl and
+#   Computer.hdl on a Python model of the chips, Prog.asm / Prog.hack on
+#   emulator.py. Output lines are checked against the .cmp file as they
+#   are produced, stopping at the first mismatch.
+import argparse
+import re
+import sys
+import time
+from array import array
+from enum import StrEnum
+from pathlib import Path
+
+from emulator import (ADDRESS_MASK, COMP_FUNCTIONS, JUMP_CONDITIONS, RAM_SIZE,
+                      Emulator, aluFunction)
+from hackasm import assemble, readImage
+from jit import JitEmulator
+
+
+TOKEN = re.compile(r'"[^"]*"|[,;!{}]|[^\s,;!{}]+')
+COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+OUTPUT_SPEC = re.compile(r'(.+)%([BXDS])(\d+)\.(\d+)\.(\d+)$')
+TERMINATORS = (',', ';', '!')
+COMPARISONS = {
+    '=': lambda x, y: x == y,
+    '<>': lambda x, y: x != y,
+    '<': lambda x, y: x < y,
+    '>': lambda x, y: x > y,
+    '<=': lambda x, y: x <= y,
+    '>=': lambda x, y: x >= y,
+}
+
+
+class Status(StrEnum):
+    PASSED = 'passed'
+    FAILED = 'failed'
+    UNSUPPORTED = 'unsupported'
+    ERROR = 'error'
+
+
+class ScriptError(Exception):
+    pass
+
+
+class Unsupported(Exception):
+    pass
+
+
+class ComparisonFailure(Exception):
+    def __init__(self, lineNumber, expected, actual):
+        super().__init__(f'comparison failure at line {lineNumber}\n'
+                         f'  expected {expected}\n  actual   {actual}')
+
+
+def toSigned(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def parseValue(text):
+    """
+    %B0101, %XFF, %D-1 or a plain decimal, as a signed 16-bit value.
+    """
+    if text.startswith('%'):
+        base = {'B': 2, 'X': 16, 'D': 10}[text[1].upper()]
+        return toSigned(int(text[2:], base) & 0xFFFF)
+    return toSigned(int(text) & 0xFFFF)
+
+
+def tokenize(script):
+    return TOKEN.findall(COMMENT.sub(' ', script))
+
+
+def parseBlock(tokens, i=0):
+    """
+    Returns (commands, index of the closing brace or the end). A command
+    is ('do', words), ('repeat', [count], body) or ('while', condition,
+    body).
+    """
+    commands = []
+    while i < len(tokens) and tokens[i] != '}':
+        if tokens[i] in TERMINATORS:
+            i += 1
+            continue
+        end = i
+        while end < len(tokens) and tokens[end] not in TERMINATORS + ('{', '}'):
+            end += 1
+        words = tokens[i:end]
+        if end < len(tokens) and tokens[end] == '{':
+            if words[0] not in ('repeat', 'while'):
+                raise ScriptError(f'unexpected block after {" ".join(words)}')
+            body, end = parseBlock(tokens, end + 1)
+            if end >= len(tokens):
+                raise ScriptError(f'{words[0]} block is not closed')
+            commands.append((words[0], words[1:], body))
+            end += 1
+        else:
+            commands.append(('do', words))
+        i = end
+    return commands, i
+
+
+def parseScript(script):
+    tokens = tokenize(script)
+    commands, i = parseBlock(tokens)
+    if i < len(tokens):
+        raise ScriptError(f'unbalanced {tokens[i]}')
+    return commands
+
+
+class OutputColumn:
+    """
+    One name%Fl.w.r entry of output-list: format B, X, D or S, padded by
+    l spaces on the left and r on the right of a w wide value.
+    """
+
+    def __init__(self, spec):
+        match = OUTPUT_SPEC.match(spec)
+        if match is None:
+            # A bare name prints as a 6 wide decimal
+            match = OUTPUT_SPEC.match(f'{spec}%D1.6.1')
+        self.name, self.format = match.group(1), match.group(2)
+        self.left, self.width, self.right = (int(n) for n in match.groups()[2:])
+
+    def header(self):
+        size = self.left + self.width + self.right
+        name = self.name[:size]
+        padding = size - len(name)
+        return ' ' * (padding // 2) + name + ' ' * (padding - padding // 2)
+
+    def cell(self, value):
+        if self.format == 'S':
+            text = str(value).ljust(self.width)
+        elif self.format == 'D':
+            text = str(value).rjust(self.width)
+        elif self.format == 'B':
+            text = format(value & (1 << self.width) - 1, f'0{self.width}b')
+        else:
+            text = format(value & 0xFFFF, f'0{self.width}X')
+        text = text[-self.width:] if self.width else ''
+        return ' ' * self.left + text + ' ' * self.right
+
+
+class CpuChip:
+    """
+    CPU.hdl, its registers split in two halves: tick computes the new A, D
+    and PC from the inputs and the current outputs, tock makes them the
+    outputs. DRegister[] and friends show the new values in between.
+    """
+    pins = ('inM', 'instruction', 'reset')
+
+    def __init__(self):
+        self.inM = self.instruction = self.reset = 0
+        self.aOut = self.dOut = self.pcOut = 0
+        self.aIn = self.dIn = self.pcIn = 0
+
+    def alu(self):
+        instruction = self.instruction
+        control = instruction >> 6 & 0b111111
+        comp = COMP_FUNCTIONS.get(control) or aluFunction(control)
+        return comp(self.dOut, self.inM if instruction & 0x1000 else self.aOut)
+
+    def isCInstruction(self):
+        return bool(self.instruction & 0x8000)
+
+    def writeM(self):
+        return int(self.isCInstruction() and bool(self.instruction & 0x8))
+
+    def addressM(self):
+        return self.aOut & ADDRESS_MASK
+
+    def get(self, name):
+        if name == 'outM':
+            return self.alu()
+        if name == 'writeM':
+            return self.writeM()
+        if name == 'addressM':
+            return self.addressM()
+        if name == 'pc':
+            return self.pcOut
+        if name in ('ARegister[]', 'ARegister[0]'):
+            return self.aIn
+        if name in ('DRegister[]', 'DRegister[0]'):
+            return self.dIn
+        if name in ('PC[]', 'PC[0]'):
+            return self.pcIn
+        if name in self.pins:
+            return toSigned(getattr(self, name) & 0xFFFF)
+        raise ScriptError(f'unknown pin {name}')
+
+    def set(self, name, value):
+        if name in self.pins:
+            setattr(self, name, value & 0xFFFF if name == 'instruction'
+                    else value)
+        elif name in ('ARegister[]', 'ARegister[0]'):
+            self.aIn = self.aOut = value
+        elif name in ('DRegister[]', 'DRegister[0]'):
+            self.dIn = self.dOut = value
+        elif name in ('PC[]', 'PC[0]'):
+            self.pcIn = self.pcOut = value & ADDRESS_MASK
+        else:
+            raise ScriptError(f'cannot set {name}')
+
+    def tick(self):
+        instruction = self.instruction
+        if not instruction & 0x8000:
+            self.aIn, self.dIn = toSigned(instruction), self.dOut
+            jumps = False
+        else:
+            out = self.alu()
+            self.aIn = out if instruction & 0x20 else self.aOut
+            self.dIn = out if instruction & 0x10 else self.dOut
+            condition = JUMP_CONDITIONS[instruction & 0b111]
+            jumps = condition is not None and condition[(out > 0) - (out < 0)]
+        if self.reset:
+            self.pcIn = 0
+        elif jumps:
+            self.pcIn = self.aOut & ADDRESS_MASK
+        else:
+            self.pcIn = (self.pcOut + 1) & ADDRESS_MASK
+
+    def tock(self):
+        self.aOut, self.dOut, self.pcOut = self.aIn, self.dIn, self.pcIn
+
+    def command(self, words):
+        raise Unsupported(f'command {" ".join(words)}')
+
+
+class ComputerChip(CpuChip):
+    """
+    Computer.hdl: the CPU wired to ROM32K and RAM16K. `ROM32K load
+    Prog.hack` fills the ROM; the CPU inputs come from ROM and RAM.
+    """
+    pins = ('reset',)
+
+    def __init__(self, folder):
+        super().__init__()
+        self.folder = folder
+        self.rom = array('H', bytes(2 * RAM_SIZE))
+        self.ram = array('h', bytes(2 * RAM_SIZE))
+
+    def fetch(self):
+        self.instruction = self.rom[self.pcOut]
+        self.inM = self.ram[self.addressM()]
+
+    def get(self, name):
+        for memory, chip in ((self.ram, 'RAM16K'), (self.rom, 'ROM32K')):
+            if name.startswith(chip + '['):
+                return toSigned(memory[int(name[len(chip)+1:-1])])
+        self.fetch()
+        return super().get(name)
+
+    def set(self, name, value):
+        if name.startswith('RAM16K['):
+            self.ram[int(name[7:-1])] = value
+        elif name.startswith('ROM32K['):
+            self.rom[int(name[7:-1])] = value & 0xFFFF
+        else:
+            super().set(name, value)
+
+    def tick(self):
+        self.fetch()
+        if self.writeM():
+            self.ram[self.addressM()] = self.alu()
+        super().tick()
+
+    def command(self, words):
+        if words[:2] != ['ROM32K', 'load'] or len(words) != 3:
+            super().command(words)
+        image = readImage(self.folder.joinpath(words[2]))
+        self.rom[:len(image)] = image
+
+
+class EmulatorTarget:
+    """
+    Prog.asm or Prog.hack on the CPU emulator: RAM[i], A, D and PC, one
+    instruction per tick-tock. Whole `repeat n { ticktock; }` blocks run
+    through the emulator's own loop.
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    @classmethod
+    def load(cls, programFilePath, jit=False):
+        if programFilePath.suffix == '.asm':
+            rom = assemble(programFilePath)[0]
+        else:
+            rom = readImage(programFilePath)
+        return cls((JitEmulator if jit else Emulator)(rom))
+
+    def get(self, name):
+        emulator = self.emulator
+        if name.startswith('RAM['):
+            return emulator.ram[int(name[4:-1])]
+        if name in ('A', 'D'):
+            return getattr(emulator, name)
+        if name == 'PC':
+            return emulator.pc
+        raise ScriptError(f'unknown variable {name}')
+
+    def set(self, name, value):
+        emulator = self.emulator
+        if name.startswith('RAM['):
+            emulator.ram[int(name[4:-1])] = value
+        elif name in ('A', 'D'):
+            setattr(emulator, name, value)
+        elif name == 'PC':
+            emulator.pc = value & ADDRESS_MASK
+        else:
+            raise ScriptError(f'cannot set {name}')
+
+    def tick(self):
+        pass
+
+    def tock(self):
+        self.emulator.step()
+
+    def run(self, cycles):
+        self.emulator.run(cycles)
+
+    def command(self, words):
+        raise Unsupported(f'command {" ".join(words)}')
+
+
+class TestScript:
+    """
+    target is one already loaded and run, e.g. a whole VM program run to
+    Sys.halt by 12/testfarm.py: the script's load keeps it and vmstep
+    does nothing.
+    """
+
+    def __init__(self, tstFilePath, jit=False, writeOutput=True, target=None):
+        self.tstFilePath = Path(tstFilePath)
+        self.folder = self.tstFilePath.parent
+        self.jit = jit
+        self.writeOutput = writeOutput
+        self.target = target
+        self.preloaded = target is not None
+        self.time = 0
+        self.halfCycle = False
+        self.columns = []
+        self.outFile = None
+        self.expected = None
+        self.lineNumber = 0
+
+    def run(self):
+        """
+        Returns (Status, message).
+        """
+        try:
+            commands = parseScript(self.tstFilePath.read_text())
+            self.execute(commands)
+            if self.expected is not None and \
+                    self.lineNumber < len(self.expected):
+                raise ComparisonFailure(self.lineNumber + 1,
+                                        self.expected[self.lineNumber],
+                                        '(no more output)')
+        except ComparisonFailure as e:
+            return Status.FAILED, str(e)
+        except Unsupported as e:
+            return Status.UNSUPPORTED, str(e)
+        except (ScriptError, OSError, ValueError, IndexError) as e:
+            return Status.ERROR, f'{type(e).__name__}: {e}'
+        finally:
+            if self.outFile is not None:
+                self.outFile.close()
+        return Status.PASSED, f'{self.lineNumber} lines compared'
+
+    def execute(self, commands):
+        for command in commands:
+            kind = command[0]
+            if kind == 'do':
+                self.do(command[1])
+            elif kind == 'repeat':
+                count, body = command[1], command[2]
+                if not count:
+                    raise Unsupported('repeat without a count')
+                self.repeat(int(count[0]), body)
+            else:
+                condition, body = command[1], command[2]
+                while self.evaluate(condition):
+                    self.execute(body)
+
+    def repeat(self, count, body):
+        if body == [('do', ['ticktock'])] and \
+                isinstance(self.target, EmulatorTarget):
+            self.target.run(count)
+            self.time += count
+            return
+        for _ in range(count):
+            self.execute(body)
+
+    def evaluate(self, condition):
+        if len(condition) != 3 or condition[1] not in COMPARISONS:
+            raise ScriptError(f'bad condition {" ".join(condition)}')
+        name, operator, value = condition
+        return COMPARISONS[operator](self.get(name), parseValue(value))
+
+    def get(self, name):
+        if name == 'time':
+            return f'{self.time}+' if self.halfCycle else str(self.time)
+        return self.requireTarget().get(name)
+
+    def requireTarget(self):
+        if self.target is None:
+            raise ScriptError('nothing loaded')
+        return self.target
+
+    def load(self, name):
+        if self.preloaded:
+            return
+        if name is None:
+            raise Unsupported('load of a whole VM folder')
+        path = self.folder.joinpath(name)
+        if path.suffix in ('.asm', '.hack'):
+            self.target = EmulatorTarget.load(path, self.jit)
+        elif path.name == 'CPU.hdl':
+            self.target = CpuChip()
+        elif path.name == 'Computer.hdl':
+            self.target = ComputerChip(self.folder)
+        else:
+            raise Unsupported(f'load {name}')
+
+    def do(self, words):
+        if not words:
+            return
+        name, args = words[0], words[1:]
+        if name == 'load':
+            self.load(args[0] if args else None)
+        elif name == 'output-file':
+            if self.writeOutput:
+                self.outFile = self.folder.joinpath(args[0]).open(mode='w')
+        elif name == 'compare-to':
+            self.expected = \
+                self.folder.joinpath(args[0]).read_text().splitlines()
+        elif name == 'output-list':
+            self.columns = [OutputColumn(spec) for spec in args]
+            self.emit('|' + '|'.join(c.header() for c in self.columns) + '|')
+        elif name == 'output':
+            self.emit('|' + '|'.join(c.cell(self.get(c.name))
+                                     for c in self.columns) + '|')
+        elif name == 'set':
+            self.requireTarget().set(args[0], parseValue(args[1]))
+        elif name == 'tick':
+            self.requireTarget().tick()
+            self.halfCycle = True
+        elif name == 'tock':
+            self.requireTarget().tock()
+            self.halfCycle = False
+            self.time += 1
+        elif name == 'ticktock':
+            self.do(['tick'])
+            self.do(['tock'])
+        elif name in ('eval', 'echo', 'clear-echo') or \
+                name == 'vmstep' and self.preloaded:
+            pass
+        else:
+            self.requireTarget().command(words)
+
+    def emit(self, line):
+        if self.outFile is not None:
+            self.outFile.write(line + '\n')
+        if self.expected is None:
+            return
+        if self.lineNumber >= len(self.expected):
+            raise ComparisonFailure(self.lineNumber + 1, '(end of file)',
+                                    line)
+        expected = self.expected[self.lineNumber]
+        self.lineNumber += 1
+        if len(expected) != len(line) or any(
+                e != a and e != '*' for e, a in zip(expected, line)):
+            raise ComparisonFailure(self.lineNumber, expected, line)
+
+
+def findScripts(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(path.rglob('*.tst'))
+        else:
+            yield path
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Run .tst scripts.')
+    argParser.add_argument('scripts', nargs='+')
+    argParser.add_argument('--jit', action='store_true',
+                           help='run programs on the basic-block JIT')
+    argParser.add_argument('--no-out', action='store_true',
+                           help='do not write the .out files')
+    args = argParser.parse_args()
+
+    counts = {status: 0 for status in Status}
+    start = time.perf_counter()
+    for tstFilePath in findScripts(args.scripts):
+        scriptStart = time.perf_counter()
+        status, message = TestScript(tstFilePath, args.jit,
+                                     not args.no_out).run()
+        seconds = time.perf_counter() - scriptStart
+        counts[status] += 1
+        print(f'{status.upper():12} {seconds * 1000:8.1f} ms  {tstFilePath}')
+        if status != Status.PASSED:
+            print(f'    {message}')
+
+    print(', '.join(f'{n} {status}' for status, n in counts.items()) +
+          f' in {time.perf_counter() - start:.2f}s')
+    sys.exit(counts[Status.FAILED] + counts[Status.ERROR] > 0)
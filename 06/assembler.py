@@ -1,80 +1,511 @@
+import argparse
+import glob
+import hashlib
+import json
 import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from os import SEEK_SET
 from pathlib import Path
 
 from symboltable import SymbolTable
 from parser import Parser, A_INSTRUCTION, L_INSTRUCTION
 import codegen
+import peephole
+
+CACHE_FOLDER = '.asmcache'
+CACHE_VERSION = 2
+
+
+def writeText(words, destFilePath):
+    with destFilePath.open(mode='w', encoding='utf-8') as dest:
+        dest.write('\n'.join(f'{word:0{16}b}' for word in words))
+
+
+def writeBinary(words, destFilePath):
+    """
+    Raw ROM image, one little-endian unsigned 16-bit word per instruction.
+    """
+    image = array('H', words)
+    if sys.byteorder == 'big':
+        image.byteswap()
+    with destFilePath.open(mode='wb') as dest:
+        image.tofile(dest)
+
+
+def readImage(imageFilePath):
+    """
+    Load a ROM image written by either writeText or writeBinary.
+    """
+    imageFilePath = Path(imageFilePath)
+    if imageFilePath.suffix == '.hack':
+        with imageFilePath.open() as src:
+            return array('H', (int(line, 2) for line in src if line.strip()))
+    image = array('H')
+    image.frombytes(imageFilePath.read_bytes())
+    if sys.byteorder == 'big':
+        image.byteswap()
+    return image
+
+
+def addressWord(symbol, address):
+    # An A-instruction only has 15 bits for its value
+    if address > 0x7FFF:
+        raise ValueError(f'@{symbol}: {address} does not fit in an A-instruction')
+    return address
+
+
+class SourceMap:
+    """
+    ROM address -> originating .asm line and the most recent comment-only
+    line before it, which for VM translator output is the VM command.
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        self.asmLines = array('I')
+        self.vmCommands = array('i')
+        self.comments = []
+        self.lastCommentLineNumber = 0
+
+    def add(self, parser):
+        if parser.commentLineNumber != self.lastCommentLineNumber:
+            self.lastCommentLineNumber = parser.commentLineNumber
+            self.comments.append(parser.comment)
+        self.asmLines.append(parser.lineNumber)
+        self.vmCommands.append(len(self.comments) - 1)
+
+    def comment(self, romAddress):
+        index = self.vmCommands[romAddress]
+        return None if index < 0 else self.comments[index]
+
+    def save(self, mapFilePath):
+        with Path(mapFilePath).open(mode='w', encoding='utf-8') as dest:
+            json.dump({
+                'source': self.source,
+                'asmLines': self.asmLines.tolist(),
+                'vmCommands': self.vmCommands.tolist(),
+                'comments': self.comments,
+            }, dest, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, mapFilePath):
+        with Path(mapFilePath).open() as src:
+            data = json.load(src)
+        sourceMap = cls(data['source'])
+        sourceMap.asmLines.extend(data['asmLines'])
+        sourceMap.vmCommands.extend(data['vmCommands'])
+        sourceMap.comments = data['comments']
+        return sourceMap
+
+
+class StreamAssembler:
+    """
+    Single-pass assembler fed incrementally, so the source never has to
+    exist as a whole. Labels are collected as they stream by, symbols used
+    before they are known are patched by finish().
+
+    Input is taken as text through write() (it can stand in for an output
+    file), as lines through feed(), or as already-split fields through
+    feedFields(). Fields carry no line numbers, so they are left out of
+    the source map.
+    """
+
+    def __init__(self, symbols=None, sourceMap=None):
+        self.symbols = SymbolTable() if symbols is None else symbols
+        self.labels = {}
+        self.variables = self.symbols.variables
+        self.sourceMap = sourceMap
+        self.lineNumber = 0
+        self.comment = None
+        self.commentLineNumber = 0
+        self.words = array('H')
+        self.forwardRefs = []
+        # Instructions already resolved share one lookup with the
+        # precomputed C-instruction table, e.g. '@SP' and 'AM=M-1'
+        self.known = dict(codegen.C_INSTRUCTIONS)
+        self.partialLine = ''
+
+    def write(self, text):
+        lines = (self.partialLine + text).split('\n')
+        self.partialLine = lines.pop()
+        self.feed(lines)
+        return len(text)
+
+    def feed(self, lines):
+        words, known, sourceMap = self.words, self.known, self.sourceMap
+        parser = Parser(lines)
+        parser.lineNumber = self.lineNumber
+        parser.comment = self.comment
+        parser.commentLineNumber = self.commentLineNumber
+        for instruction in parser.instructions():
+            word = known.get(instruction)
+            if word is not None:
+                words.append(word)
+            else:
+                instructionType = parser.instructionType()
+                if instructionType == L_INSTRUCTION:
+                    self.addLabel(parser.symbol())
+                    continue
+                if instructionType == A_INSTRUCTION:
+                    word = self.addAddress(parser.symbol())
+                    if word is not None:
+                        known[instruction] = word
+                else:
+                    words.append(codegen.encode(
+                        parser.dest(), parser.comp(), parser.jump()))
+            if sourceMap is not None:
+                sourceMap.add(parser)
+        self.lineNumber = parser.lineNumber
+        self.comment = parser.comment
+        self.commentLineNumber = parser.commentLineNumber
+
+    def feedFields(self, fields):
+        """
+        fields yields (L_INSTRUCTION, symbol), (A_INSTRUCTION, symbol) or
+        (C_INSTRUCTION, dest, comp, jump) with 'null' for an absent part.
+        """
+        for field in fields:
+            if field[0] == L_INSTRUCTION:
+                self.addLabel(field[1])
+            elif field[0] == A_INSTRUCTION:
+                self.addAddress(field[1])
+            else:
+                self.words.append(codegen.encode(*field[1:]))
+
+    def addLabel(self, symbol):
+        self.symbols.addEntry(symbol, len(self.words))
+        self.labels[symbol] = len(self.words)
+
+    def addAddress(self, symbol):
+        if symbol.isdecimal():
+            address = int(symbol)
+        else:
+            address = self.symbols.get(symbol)
+        if address is None:
+            self.forwardRefs.append((len(self.words), symbol))
+            self.words.append(0)
+            return None
+        self.words.append(addressWord(symbol, address))
+        return address
+
+    def close(self):
+        self.finish()
+
+    def finish(self):
+        if self.partialLine:
+            self.feed([self.partialLine])
+            self.partialLine = ''
+
+        # Anything that never became a label is a variable, allocated in
+        # order of first use like the two-pass mode
+        for romAddress, symbol in self.forwardRefs:
+            self.words[romAddress] = addressWord(
+                symbol, self.symbols.getOrAllocate(symbol))
+        self.forwardRefs = []
+        return self.words
+
+
+def fileDigest(filePath):
+    try:
+        return hashlib.sha256(Path(filePath).read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def cacheFilePath(sourceFilePath, options):
+    """
+    One entry per source and output options, so e.g. the .hack and the
+    .bin builds of a source do not evict each other.
+    """
+    sourceFilePath = Path(sourceFilePath).resolve()
+    optionsDigest = hashlib.sha256(
+        json.dumps(sorted(options.items())).encode()).hexdigest()[:16]
+    return sourceFilePath.parent.joinpath(
+        CACHE_FOLDER, f'{sourceFilePath.stem}.{optionsDigest}.json')
+
+
+def cacheKey(sourceFilePath, symbols, options):
+    """
+    Hash of everything the output depends on: the source text, the
+    predefined symbols and the output options.
+    """
+    key = hashlib.sha256(Path(sourceFilePath).read_bytes())
+    key.update(json.dumps([CACHE_VERSION, sorted(symbols.entries()),
+                           sorted(options.items())]).encode())
+    return key.hexdigest()
+
+
+def readCacheEntry(entryFilePath):
+    try:
+        with Path(entryFilePath).open() as src:
+            return json.load(src)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def loadSymbols(sourceFilePath):
+    """
+    Labels and variables from the last cached assembly, or None when the
+    source has changed since. Nothing is assembled.
+    """
+    sourceFilePath = Path(sourceFilePath).resolve()
+    entries = sourceFilePath.parent.joinpath(CACHE_FOLDER).glob(
+        f'{sourceFilePath.stem}.*.json')
+    for entryFilePath in sorted(entries, key=lambda p: p.stat().st_mtime,
+                                reverse=True):
+        entry = readCacheEntry(entryFilePath)
+        if entry is not None and entry['key'] == cacheKey(
+                sourceFilePath, SymbolTable(), entry['options']):
+            return entry['labels'], entry['variables']
+    return None
 
 
 class Assembler:
-    def __init__(self, sourceFilePath):
+    def __init__(self, sourceFilePath, singlePass=False, binary=False,
+                 sourceMap=False, cache=False, optimize=False):
         sourceFilePath = Path(sourceFilePath).resolve()
         workingPath = sourceFilePath.parent
-        destFilePath = workingPath.joinpath(f'{sourceFilePath.stem}.hack')
+        suffix = '.bin' if binary else '.hack'
+        destFilePath = workingPath.joinpath(f'{sourceFilePath.stem}{suffix}')
+        mapFilePath = workingPath.joinpath(f'{sourceFilePath.stem}.map.json')
+
+        if optimize and sourceMap:
+            raise ValueError('the source map follows .asm lines, '
+                             'which the optimizer rewrites')
+
+        # Seconds spent per phase, see lap()
+        self.timings = {}
+        self.lastLap = time.perf_counter()
 
         symbols = SymbolTable()
-        for i in range(16):
-            symbols.addEntry(f'R{i}', i)
-        symbols.addEntry('SP', 0)
-        symbols.addEntry('LCL', 1)
-        symbols.addEntry('ARG', 2)
-        symbols.addEntry('THIS', 3)
-        symbols.addEntry('THAT', 4)
-        symbols.addEntry('SCREEN', 16384)
-        symbols.addEntry('KBD', 24576)
+        self.upToDate = False
+        self.report = None
+        if cache:
+            options = dict(binary=binary, sourceMap=sourceMap,
+                           optimize=optimize)
+            key = cacheKey(sourceFilePath, symbols, options)
+            if self.loadCached(cacheFilePath(sourceFilePath, options), key,
+                               destFilePath,
+                               mapFilePath if sourceMap else None):
+                self.lap('cache')
+                return
+
+        # The source map is recorded by the single-pass engine
+        self.sourceMap = SourceMap(sourceFilePath.name) if sourceMap else None
+        if optimize:
+            self.words = self.assembleOptimized(sourceFilePath, symbols)
+        elif singlePass or sourceMap:
+            self.words = self.assembleOnce(sourceFilePath, symbols)
+        else:
+            self.words = self.assembleTwice(sourceFilePath, symbols)
+
+        if self.sourceMap is not None:
+            self.sourceMap.save(mapFilePath)
+
+        if binary:
+            writeBinary(self.words, destFilePath)
+        else:
+            writeText(self.words, destFilePath)
+        self.lap('write')
+
+        if cache:
+            entry = cacheFilePath(sourceFilePath, options)
+            entry.parent.mkdir(exist_ok=True)
+            with entry.open(mode='w', encoding='utf-8') as dest:
+                json.dump({
+                    'key': key,
+                    'options': options,
+                    'outputDigest': fileDigest(destFilePath),
+                    'mapDigest': fileDigest(mapFilePath) if sourceMap else None,
+                    'labels': self.labels,
+                    'variables': self.variables,
+                    'report': self.report,
+                }, dest)
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self.lastLap
+        self.lastLap = now
 
+    def loadCached(self, entryFilePath, key, destFilePath, mapFilePath):
+        entry = readCacheEntry(entryFilePath)
+        if entry is None or entry['key'] != key:
+            return False
+        if fileDigest(destFilePath) != entry['outputDigest']:
+            return False
+        if mapFilePath is not None and \
+                fileDigest(mapFilePath) != entry['mapDigest']:
+            return False
+
+        self.upToDate = True
+        self.words = readImage(destFilePath)
+        self.sourceMap = SourceMap.load(mapFilePath) if mapFilePath else None
+        self.labels = entry['labels']
+        self.variables = entry['variables']
+        self.report = entry['report']
+        return True
+
+    def assembleTwice(self, sourceFilePath, symbols):
         # Phase 1
         src = sourceFilePath.open()
         parser = Parser(src)
         linenumber = -1
+        self.labels = {}
         while parser.hasMoreLines():
             parser.advance()
             if parser.instructionType() == L_INSTRUCTION:
                 symbols.addEntry(parser.symbol(), linenumber + 1)
+                self.labels[parser.symbol()] = linenumber + 1
             else:
                 linenumber += 1
+        self.lap('labels')
 
         # Phase 2
         src.seek(0, SEEK_SET)
-        dest = destFilePath.open(mode='w', encoding='utf-8')
-
         parser = Parser(src)
-        fieldTable = [
-            (parser.comp, codegen.comp),
-            (parser.dest, codegen.dest),
-            (parser.jump, codegen.jump),
-        ]
-
-        firstLine = True
-        nextAvailableAddress = 16
+
+        words = array('H')
+        self.variables = symbols.variables
         while parser.hasMoreLines():
             parser.advance()
             if parser.instructionType() == L_INSTRUCTION:
                 continue
 
-            if not firstLine:
-                dest.write('\n')
-            firstLine = False
-
             if parser.instructionType() == A_INSTRUCTION:
                 if not parser.symbol().isdecimal():
-                    if not symbols.contains(parser.symbol()):
-                        symbols.addEntry(parser.symbol(), nextAvailableAddress)
-                        nextAvailableAddress += 1
-                    address = symbols.getAddress(parser.symbol())
+                    address = symbols.getOrAllocate(parser.symbol())
                 else:
                     address = int(parser.symbol())
-                machineCode = f'{address:0{16}b}'
+                words.append(addressWord(parser.symbol(), address))
             else:
-                machineCode = '111'
-                for parse, gen in fieldTable:
-                    machineCode += gen(parse())
-            dest.write(f'{machineCode}')
+                word = codegen.C_INSTRUCTIONS.get(parser.currentInstruction)
+                if word is None:
+                    word = codegen.encode(
+                        parser.dest(), parser.comp(), parser.jump())
+                words.append(word)
 
-        dest.close()
         src.close()
+        self.lap('encode')
+        return words
+
+    def assembleOnce(self, sourceFilePath, symbols):
+        # Read the source sequentially once, patching forward references
+        # at the end
+        stream = StreamAssembler(symbols, self.sourceMap)
+        with sourceFilePath.open() as src:
+            stream.feed(src)
+        self.lap('encode')
+        words = stream.finish()
+        self.lap('link')
+        self.labels = stream.labels
+        self.variables = stream.variables
+        return words
+
+    def assembleOptimized(self, sourceFilePath, symbols):
+        with sourceFilePath.open() as src:
+            instructions = list(Parser(src).instructions())
+        self.lap('parse')
+        instructions, self.report = peephole.optimize(instructions)
+        self.lap('optimize')
+
+        stream = StreamAssembler(symbols)
+        stream.feed(instructions)
+        self.lap('encode')
+        words = stream.finish()
+        self.lap('link')
+        self.labels = stream.labels
+        self.variables = stream.variables
+        return words
+
+
+def findSources(patterns):
+    """
+    Expand files, directory trees and glob patterns into .asm paths.
+    """
+    sources = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            sources.extend(sorted(path.rglob('*.asm')))
+        elif path.is_file():
+            sources.append(path)
+        else:
+            sources.extend(sorted(Path(p)
+                           for p in glob.glob(pattern, recursive=True)))
+    return sources
+
+
+def assembleFile(sourceFilePath, **options):
+    """
+    Batch worker, returns (path, seconds, error) instead of raising.
+    options are passed on to Assembler.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        Assembler(sourceFilePath, **options)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return sourceFilePath, time.perf_counter() - start, error
+
+
+def assembleBatch(patterns, workers=None, **options):
+    """
+    Assemble every matching .asm file across a process pool. A failing
+    file is reported in the results and does not stop the others.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(assembleFile, source, **options)
+                   for source in findSources(patterns)]
+        for future in as_completed(futures):
+            results.append(future.result())
+    return sorted(results)
 
 
 if __name__ == '__main__':
-    Assembler(sys.argv[1])
+    argParser = argparse.ArgumentParser(
+        description='Assemble Hack .asm files into .hack ROM images.')
+    argParser.add_argument('sources', nargs='+',
+                           help='.asm files, directories or glob patterns')
+    argParser.add_argument('--single-pass', action='store_true')
+    argParser.add_argument('--binary', action='store_true',
+                           help='write a raw little-endian .bin image')
+    argParser.add_argument('--source-map', action='store_true',
+                           help='write a .map.json sidecar, implies --single-pass')
+    argParser.add_argument('--optimize', action='store_true',
+                           help='run the peephole optimizer before encoding')
+    argParser.add_argument('--cache', action='store_true',
+                           help=f'skip sources unchanged since the last run, '
+                           f'see {CACHE_FOLDER}/')
+    argParser.add_argument('--jobs', type=int, default=None,
+                           help='worker processes for batch assembly')
+    args = argParser.parse_args()
+    options = dict(singlePass=args.single_pass, binary=args.binary,
+                   sourceMap=args.source_map, cache=args.cache,
+                   optimize=args.optimize)
+
+    if len(args.sources) == 1 and Path(args.sources[0]).is_file():
+        try:
+            assembler = Assembler(args.sources[0], **options)
+        except ValueError as e:
+            sys.exit(f'{args.sources[0]}: {e}')
+        if assembler.report is not None:
+            report = assembler.report
+            print(f'ROM {report["romBefore"]} -> {report["romAfter"]} words, '
+                  f'~{report["cyclesSaved"]} cycles saved per pass over '
+                  f'the rewritten code')
+        sys.exit()
+
+    results = assembleBatch(args.sources, args.jobs, **options)
+    failed = 0
+    total = 0
+    for sourceFilePath, seconds, error in results:
+        total += seconds
+        print(f'{seconds * 1000:10.1f} ms  {sourceFilePath}'
+              f'{"" if error is None else "  FAILED: " + error}')
+        failed += error is not None
+    print(f'{len(results)} files, {failed} failed, {total:.2f} s total')
+    sys.exit(1 if failed else 0)
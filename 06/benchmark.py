@@ -0,0 +1,163 @@
+# usage: python benchmark.py [real.asm ...] [--lines N] [--label-density F]
+#                            [--variable-density F] [--repeat N]
+#                            [--single-pass] [--optimize] [--json results.json]
+#   Times the assembler on a synthetic program plus the given real ones
+#   (Pong by default; Tetris etc. once built by 11/ and 08/). With
+#   --optimize, programs the peephole optimizer refuses are listed as
+#   such, e.g. Pong, which jumps to numeric ROM addresses.
+import argparse
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from assembler import Assembler
+from parser import Parser
+import codegen
+import peephole
+
+# Labels past this ROM address could not be referenced by an A-instruction
+MAX_LABEL_ADDRESS = 0x7FFF
+COMMON_C_INSTRUCTIONS = [
+    'M=M+1', 'AM=M-1', 'A=M-1', 'D=M', 'M=D', 'D=A', 'AD=D+A',
+    'D=D-A', 'M=D+M', 'D;JNE', 'D;JEQ', '0;JMP', 'A=M', 'M=-1', 'M=0',
+]
+
+
+def synthesize(path, lines, labelDensity, variableDensity, seed=0):
+    """
+    Write a syntactically valid program of about `lines` instructions.
+    Densities are the share of lines that define a label or reference a
+    variable; every referenced label is defined somewhere. Jumps always
+    target labels, so the peephole optimizer accepts the program.
+    """
+    rng = random.Random(seed)
+    labelCount = max(1, int(lines * labelDensity))
+    variableCount = max(1, min(int(lines * variableDensity), 16000))
+    labelAt = sorted(rng.sample(range(min(lines, MAX_LABEL_ADDRESS)),
+                                min(labelCount, MAX_LABEL_ADDRESS, lines)))
+    labels = [f'L{i}' for i in range(len(labelAt))]
+    nextLabel = 0
+    cInstructions = COMMON_C_INSTRUCTIONS + \
+        rng.sample(sorted(codegen.C_INSTRUCTIONS), 64)
+
+    out = []
+    constant = False
+    for address in range(lines):
+        if nextLabel < len(labelAt) and labelAt[nextLabel] == address:
+            out.append(f'({labels[nextLabel]})\n')
+            nextLabel += 1
+            constant = False
+        roll = rng.random()
+        if roll < variableDensity:
+            out.append(f'@v{rng.randrange(variableCount)}\n')
+            constant = False
+        elif roll < variableDensity + 0.1:
+            out.append(f'@{rng.choice(labels)}\n')
+            constant = False
+        elif roll < variableDensity + 0.3:
+            out.append(f'@{rng.randrange(32768)}  // constant\n')
+            constant = True
+        else:
+            instruction = rng.choice(cInstructions)
+            if constant and ';' in instruction:
+                out[-1] = f'@{rng.choice(labels)}\n'
+            out.append(f'{instruction}\n')
+            constant = False
+
+    with Path(path).open(mode='w', encoding='utf-8') as dest:
+        dest.writelines(out)
+
+
+def refusal(path):
+    """
+    Why the peephole optimizer refuses the program, or None.
+    """
+    with Path(path).open() as src:
+        try:
+            peephole.checkJumpTargets(list(Parser(src).instructions()))
+        except ValueError as e:
+            return str(e)
+    return None
+
+
+def countLines(path):
+    with Path(path).open() as src:
+        return sum(1 for _ in src)
+
+
+def measure(path, repeat, **options):
+    """
+    Best-of-repeat wall time and phase timings, then one extra run under
+    tracemalloc for the peak Python memory.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        assembler = Assembler(path, **options)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[0]:
+            best = (seconds, assembler.timings)
+
+    tracemalloc.start()
+    Assembler(path, **options)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds, timings = best
+    lines = countLines(path)
+    return {
+        'file': str(path),
+        'lines': lines,
+        'seconds': seconds,
+        'linesPerSecond': lines / seconds,
+        'peakBytes': peak,
+        'phases': timings,
+    }
+
+
+def printResult(result):
+    phases = '  '.join(f'{phase} {seconds * 1000:.1f}'
+                       for phase, seconds in result['phases'].items())
+    print(f'{Path(result["file"]).name:24} {result["lines"]:9} lines '
+          f'{result["linesPerSecond"]:12,.0f} lines/s '
+          f'{result["peakBytes"] / 2**20:8.1f} MiB peak  ms: {phases}')
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Assembler throughput.')
+    argParser.add_argument('sources', nargs='*',
+                           default=[str(Path(__file__).parent / 'pong/Pong.asm')])
+    argParser.add_argument('--lines', type=int, default=200000)
+    argParser.add_argument('--label-density', type=float, default=0.02)
+    argParser.add_argument('--variable-density', type=float, default=0.01)
+    argParser.add_argument('--repeat', type=int, default=3)
+    argParser.add_argument('--single-pass', action='store_true')
+    argParser.add_argument('--optimize', action='store_true')
+    argParser.add_argument('--json', help='also write the results here')
+    args = argParser.parse_args()
+    options = dict(singlePass=args.single_pass, optimize=args.optimize)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic = Path(tmp).joinpath('Synthetic.asm')
+        synthesize(synthetic, args.lines, args.label_density,
+                   args.variable_density)
+        for source in [synthetic, *args.sources]:
+            reason = refusal(source) if args.optimize else None
+            if reason is not None:
+                print(f'{Path(source).name:24} refused: {reason}')
+                continue
+            try:
+                result = measure(source, args.repeat, **options)
+            except Exception as e:
+                print(f'{Path(source).name:24} FAILED: {type(e).__name__}: {e}')
+                continue
+            printResult(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, mode='w', encoding='utf-8') as dest:
+            json.dump(results, dest, indent=2)
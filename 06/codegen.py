@@ -1,60 +1,100 @@
+from itertools import permutations
+
+COMP_CODES = {
+    '0':   0b0101010,
+    '1':   0b0111111,
+    '-1':  0b0111010,
+    'D':   0b0001100,
+    'A':   0b0110000,
+    'M':   0b1110000,
+    '!D':  0b0001101,
+    '!A':  0b0110001,
+    '!M':  0b1110001,
+    '-D':  0b0001111,
+    '-A':  0b0110011,
+    '-M':  0b1110011,
+    'D+1': 0b0011111,
+    'A+1': 0b0110111,
+    'M+1': 0b1110111,
+    'D-1': 0b0001110,
+    'A-1': 0b0110010,
+    'M-1': 0b1110010,
+    'D+A': 0b0000010,
+    'D+M': 0b1000010,
+    'D-A': 0b0010011,
+    'D-M': 0b1010011,
+    'A-D': 0b0000111,
+    'M-D': 0b1000111,
+    'D&A': 0b0000000,
+    'D&M': 0b1000000,
+    'D|A': 0b0010101,
+    'D|M': 0b1010101
+}
+DEST_BITS = {'A': 0b100, 'D': 0b010, 'M': 0b001}
+JUMP_CODES = {
+    'null': 0b000,
+    'JGT':  0b001,
+    'JEQ':  0b010,
+    'JGE':  0b011,
+    'JLT':  0b100,
+    'JNE':  0b101,
+    'JLE':  0b110,
+    'JMP':  0b111
+}
+
+
 def dest(mnemonic):
-    bin = ['0', '0', '0']
-    if mnemonic != "null":
-        dst = 'ADM'
-        for d in mnemonic:
-            bin[dst.find(d)] = '1'
-    return ''.join(bin)
+    return f'{destCode(mnemonic):0{3}b}'
 
 
 def comp(mnemonic):
-    compTable = {
-        '0':   '0101010',
-        '1':   '0111111',
-        '-1':  '0111010',
-        'D':   '0001100',
-        'A':   '0110000',
-        'M':   '1110000',
-        '!D':  '0001101',
-        '!A':  '0110001',
-        '!M':  '1110001',
-        '-D':  '0001111',
-        '-A':  '0110011',
-        '-M':  '1110011',
-        'D+1': '0011111',
-        'A+1': '0110111',
-        'M+1': '1110111',
-        'D-1': '0001110',
-        'A-1': '0110010',
-        'M-1': '1110010',
-        'D+A': '0000010',
-        'D+M': '1000010',
-        'D-A': '0010011',
-        'D-M': '1010011',
-        'A-D': '0000111',
-        'M-D': '1000111',
-        'D&A': '0000000',
-        'D&M': '1000000',
-        'D|A': '0010101',
-        'D|M': '1010101'
-    }
-    return compTable[mnemonic]
+    return f'{COMP_CODES[mnemonic]:0{7}b}'
 
 
 def jump(mnemonic):
-    if mnemonic == 'null':
-        return '000'
-    if mnemonic == 'JGT':
-        return '001'
-    if mnemonic == 'JEQ':
-        return '010'
-    if mnemonic == 'JGE':
-        return '011'
-    if mnemonic == 'JLT':
-        return '100'
-    if mnemonic == 'JNE':
-        return '101'
-    if mnemonic == 'JLE':
-        return '110'
-    if mnemonic == 'JMP':
-        return '111'
+    return f'{JUMP_CODES[mnemonic]:0{3}b}'
+
+
+def destCode(mnemonic):
+    code = 0
+    if mnemonic != 'null':
+        for d in mnemonic:
+            code |= DEST_BITS[d]
+    return code
+
+
+def compCode(mnemonic):
+    return COMP_CODES[mnemonic]
+
+
+def jumpCode(mnemonic):
+    return JUMP_CODES[mnemonic]
+
+
+def encode(destMnemonic, compMnemonic, jumpMnemonic):
+    return 0b111 << 13 | compCode(compMnemonic) << 6 | \
+        destCode(destMnemonic) << 3 | jumpCode(jumpMnemonic)
+
+
+def buildInstructionTable():
+    """
+    Every legal 'dest=comp;jump' spelling, dest letters in any order,
+    mapped to its machine word.
+    """
+    dests = ['null']
+    for n in range(1, len(DEST_BITS) + 1):
+        dests.extend(''.join(p) for p in permutations(DEST_BITS, n))
+
+    table = {}
+    for d in dests:
+        for c in COMP_CODES:
+            for j in JUMP_CODES:
+                instruction = c if d == 'null' else f'{d}={c}'
+                if j != 'null':
+                    instruction += f';{j}'
+                table[instruction] = encode(d, c, j)
+    return table
+
+
+# Shared by every file assembled in this process
+C_INSTRUCTIONS = buildInstructionTable()
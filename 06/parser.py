@@ -5,10 +5,22 @@ C_INSTRUCTION = 1
 L_INSTRUCTION = 2
 
 
+def stripComment(line):
+    slash = line.find('//')
+    if slash != -1:
+        line = line[:slash]
+    return line.strip()
+
+
 class Parser:
     def __init__(self, file):
         self.f = file
         self.currentInstruction = None
+        # Position bookkeeping for instructions(), the last comment-only
+        # line is e.g. the '// push constant 7' the VM translator emits
+        self.lineNumber = 0
+        self.comment = None
+        self.commentLineNumber = 0
 
     def hasMoreLines(self) -> bool:
         cur_pos = self.f.tell()
@@ -18,15 +30,26 @@ class Parser:
 
     def advance(self) -> None:
         while True:
-            line = self.f.readline()
-            slash = line.rfind('//')
-            if slash != -1:
-                line = line[:slash]
-            line = line.strip()
-            if len(line) > 0 and not line.startswith('//'):
+            line = stripComment(self.f.readline())
+            if len(line) > 0:
                 self.currentInstruction = line
                 break
 
+    def instructions(self):
+        """
+        Walk the remaining lines in one sequential read, making each
+        instruction current in turn. Works on any iterable of lines.
+        """
+        for line in self.f:
+            self.lineNumber += 1
+            instruction = stripComment(line)
+            if len(instruction) > 0:
+                self.currentInstruction = instruction
+                yield instruction
+            elif line.lstrip().startswith('//'):
+                self.comment = line.strip()[2:].strip()
+                self.commentLineNumber = self.lineNumber
+
     def instructionType(self):
         if self.currentInstruction.startswith('@'):
             return A_INSTRUCTION
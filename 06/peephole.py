@@ -0,0 +1,183 @@
+"""
+Peephole optimizer over a list of Hack assembly instructions (comments
+already stripped, labels kept as '(LABEL)'), run before encoding.
+
+Rewrites keep the program's effect on registers and named memory, but
+they move ROM addresses, so code jumping to numeric ROM addresses
+instead of labels is refused, see checkJumpTargets().
+"""
+
+# stack[SP++] = D followed by D = stack[--SP], as emitted by the VM translator
+PUSH_POP_D = ['@SP', 'M=M+1', 'A=M-1', 'M=D', '@SP', 'AM=M-1', 'D=M']
+
+# Executed instructions saved each time the rewritten code runs. Dropping
+# unreachable code only saves ROM.
+CYCLE_SAVING_PASSES = ('pushPop', 'deadLoads', 'redundantLoads', 'jumpsToNext')
+
+
+def isLabel(instruction):
+    return instruction.startswith('(')
+
+
+def isAddress(instruction):
+    return instruction.startswith('@')
+
+
+def dest(instruction):
+    eqIndex = instruction.find('=')
+    return '' if eqIndex < 0 else instruction[:eqIndex]
+
+
+def jump(instruction):
+    semicolonIndex = instruction.find(';')
+    return '' if semicolonIndex < 0 else instruction[semicolonIndex+1:]
+
+
+def romSize(instructions):
+    return sum(not isLabel(i) for i in instructions)
+
+
+def checkJumpTargets(instructions):
+    """
+    Raise ValueError for programs whose jumps name ROM addresses: a jump
+    right after a numeric @N, or jumps without any labels.
+    """
+    if not any(isLabel(i) for i in instructions) and \
+            any(not isAddress(i) and jump(i) for i in instructions):
+        raise ValueError('jumps without labels would use ROM addresses '
+                         'the optimizer moves')
+    for previous, instruction in zip(instructions, instructions[1:]):
+        if isAddress(previous) and previous[1:].isdecimal() and \
+                not isAddress(instruction) and not isLabel(instruction) \
+                and jump(instruction):
+            raise ValueError(f'{previous}; {instruction} jumps to a ROM '
+                             f'address the optimizer moves')
+
+
+def removePushPop(instructions, report):
+    """
+    A push of D straight followed by a pop into D leaves D as it was. The
+    pop also leaves A pointing at the stack, so only drop the pair when the
+    next instruction reloads A anyway.
+    """
+    out = []
+    i = 0
+    n = len(PUSH_POP_D)
+    while i < len(instructions):
+        if instructions[i:i+n] == PUSH_POP_D and i + n < len(instructions) \
+                and isAddress(instructions[i+n]):
+            report['pushPop'] += n
+            i += n
+            continue
+        out.append(instructions[i])
+        i += 1
+    return out
+
+
+def removeDeadLoads(instructions, report):
+    """
+    @a straight followed by @b: the first load is never used.
+    """
+    out = []
+    for i, instruction in enumerate(instructions):
+        if isAddress(instruction) and i + 1 < len(instructions) \
+                and isAddress(instructions[i+1]):
+            report['deadLoads'] += 1
+            continue
+        out.append(instruction)
+    return out
+
+
+def removeRedundantLoads(instructions, report):
+    """
+    @X when A already holds X, i.e. nothing since the last @X wrote A and
+    no label let control in from elsewhere.
+    """
+    out = []
+    current = None
+    for instruction in instructions:
+        if isLabel(instruction):
+            current = None
+        elif isAddress(instruction):
+            if instruction == current:
+                report['redundantLoads'] += 1
+                continue
+            current = instruction
+        elif 'A' in dest(instruction):
+            current = None
+        out.append(instruction)
+    return out
+
+
+def removeJumpsToNext(instructions, report):
+    """
+    @L; 0;JMP (or any jump that stores nothing) right before (L).
+    """
+    out = []
+    i = 0
+    while i < len(instructions):
+        instruction = instructions[i]
+        if isAddress(instruction) and i + 1 < len(instructions):
+            following = instructions[i+1]
+            if not isAddress(following) and not isLabel(following) \
+                    and jump(following) and not dest(following):
+                j = i + 2
+                while j < len(instructions) and isLabel(instructions[j]):
+                    if instructions[j] == f'({instruction[1:]})':
+                        report['jumpsToNext'] += 2
+                        i += 2
+                        break
+                    j += 1
+                else:
+                    out.append(instruction)
+                    i += 1
+                continue
+        out.append(instruction)
+        i += 1
+    return out
+
+
+def removeUnreachable(instructions, report):
+    """
+    Instructions after an unconditional jump and before the next label.
+    """
+    out = []
+    reachable = True
+    for instruction in instructions:
+        if isLabel(instruction):
+            reachable = True
+        elif not reachable:
+            report['unreachable'] += 1
+            continue
+        elif jump(instruction) == 'JMP':
+            reachable = False
+        out.append(instruction)
+    return out
+
+
+def optimize(instructions):
+    """
+    Run every pass until none of them changes anything.
+    Returns the new instruction list and a report of what was saved.
+    """
+    checkJumpTargets(instructions)
+    report = {
+        'romBefore': romSize(instructions),
+        'pushPop': 0,
+        'deadLoads': 0,
+        'redundantLoads': 0,
+        'jumpsToNext': 0,
+        'unreachable': 0,
+    }
+    passes = [removePushPop, removeDeadLoads, removeRedundantLoads,
+              removeJumpsToNext, removeUnreachable]
+    while True:
+        before = len(instructions)
+        for optimizationPass in passes:
+            instructions = optimizationPass(instructions, report)
+        if len(instructions) == before:
+            break
+
+    report['romAfter'] = romSize(instructions)
+    report['cyclesSaved'] = sum(report[p] for p in CYCLE_SAVING_PASSES)
+    return instructions, report
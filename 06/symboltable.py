@@ -1,12 +1,79 @@
+import json
+from pathlib import Path
+from types import MappingProxyType
+
+VARIABLE_BASE_ADDRESS = 16
+
+
+def buildPredefined():
+    tb = {f'R{i}': i for i in range(16)}
+    tb.update(SP=0, LCL=1, ARG=2, THIS=3, THAT=4, SCREEN=16384, KBD=24576)
+    return MappingProxyType(tb)
+
+
+# Built once, shared read-only by every table in the process
+PREDEFINED = buildPredefined()
+
+
 class SymbolTable:
-    def __init__(self):
+    """
+    Per-file symbols on top of an immutable base, the predefined symbols
+    unless told otherwise. Variables are allocated from address 16 on.
+    """
+
+    def __init__(self, base=PREDEFINED):
+        self.base = base
         self.tb = dict()
+        self.variables = dict()
+        self.nextVariableAddress = VARIABLE_BASE_ADDRESS
 
     def addEntry(self, symbol, address):
         self.tb[symbol] = address
 
     def contains(self, symbol):
-        return symbol in self.tb
+        return symbol in self.tb or symbol in self.base
 
     def getAddress(self, symbol):
-        return self.tb[symbol]
+        address = self.tb.get(symbol)
+        return self.base[symbol] if address is None else address
+
+    def get(self, symbol):
+        """
+        Address of symbol, None when it is unknown.
+        """
+        address = self.tb.get(symbol)
+        return self.base.get(symbol) if address is None else address
+
+    def getOrAllocate(self, symbol):
+        """
+        Address of symbol, allocating it as the next variable when unknown.
+        """
+        address = self.get(symbol)
+        if address is None:
+            address = self.nextVariableAddress
+            self.tb[symbol] = self.variables[symbol] = address
+            self.nextVariableAddress += 1
+        return address
+
+    def entries(self):
+        return {**self.base, **self.tb}.items()
+
+    def dump(self, filePath):
+        with Path(filePath).open(mode='w', encoding='utf-8') as dest:
+            json.dump({
+                'base': None if self.base is PREDEFINED else dict(self.base),
+                'symbols': self.tb,
+                'variables': list(self.variables),
+                'nextVariableAddress': self.nextVariableAddress,
+            }, dest)
+
+    @classmethod
+    def load(cls, filePath):
+        with Path(filePath).open() as src:
+            data = json.load(src)
+        base = data['base']
+        symbols = cls(PREDEFINED if base is None else MappingProxyType(base))
+        symbols.tb = data['symbols']
+        symbols.variables = {v: symbols.tb[v] for v in data['variables']}
+        symbols.nextVariableAddress = data['nextVariableAddress']
+        return symbols
@@ -1,6 +1,6 @@
 from enum import StrEnum
 from pathlib import Path
-from typing import Self
+from typing import Self, TextIO
 
 from parser import CommandType
 
@@ -34,16 +34,54 @@ BaseAddressLocation = {
     'static': lambda fname, i: f'{fname}.{i}'
 }
 WrapperFuncName = 'Sys._wrapper'
+# Shared call/return code. Its labels all have a '$', so profilers never
+# mistake a jump to it for a call, and credit its cycles to the wrapper
+CallStubLabel = f'{WrapperFuncName}$call'
+ReturnStubLabel = f'{WrapperFuncName}$return'
+# Entry of the return stub for a return value already in D
+ReturnTopStubLabel = f'{WrapperFuncName}$returnD'
+# Buffered snippets are written out in one block once there are this many
+FlushChunks = 4096
+# With a cached top, pops up to this far into a pointer based segment step A
+# to the address instead of going through R13 and R14
+MaxAddressSteps = 6
 
 
 class CodeWriter:
-    def __init__(self, output_file: Path, bootstrap: bool = False) -> Self:
-        self.f = output_file.open(mode='w', encoding="utf-8")
+    def __init__(self, output_file: Path, bootstrap: bool = False, stream: TextIO | None = None,
+                 sharedCalls: bool = False, sharedCompares: bool = False,
+                 cacheTop: bool = False) -> Self:
+        """
+        stream: write into it instead of opening output_file,
+        e.g. a streaming assembler
+        sharedCalls: calls and returns jump to one copy of the frame
+        handling code, written at the end, instead of inlining it. A call
+        site only loads its return address and jumps to an entry stub,
+        one per called function, which sets up the call stub
+        sharedCompares: the same for eq, gt and lt, one routine each
+        cacheTop: keep the top of the stack in D within basic blocks,
+        spilling it at labels, jumps, calls and returns
+        """
+        self.sharedCalls = sharedCalls
+        # (function, nArgs) of every shared call site, one entry stub each
+        self.callEntries = set()
+        self.sharedCompares = sharedCompares
+        self.compareStubs = set()
+        self.cacheTop = cacheTop
+        # Whether the top of the stack is in D instead of RAM[SP-1]
+        self.cached = False
+        self.f = output_file.open(mode='w', encoding="utf-8") if stream is None else stream
+        # Snippets go to a list, joined and written at command boundaries.
+        # Commands without labels always produce the same text, so that
+        # text is cached per command.
+        self.chunks = []
+        self.write = self.chunks.append
+        self.templates = {}
         self.setFile(output_file.stem)
         self.setFunc(WrapperFuncName)
 
         if bootstrap:
-            self.f.write(f"""\
+            self.write(f"""\
 @256
 D=A
 @SP
@@ -51,6 +89,32 @@ M=D
 """)
             self.writeCall('Sys.init', 0)
 
+    def flush(self) -> None:
+        self.f.write(''.join(self.chunks))
+        self.chunks.clear()
+
+    def writeComment(self, comment: str) -> None:
+        """
+        Starts a command, so a full buffer can be flushed here.
+        """
+        if len(self.chunks) >= FlushChunks:
+            self.flush()
+        self.write(f'// {comment}\n')
+
+    def writeCached(self, key: tuple, emit) -> None:
+        """
+        Write the text emit() produces, running it only the first time
+        for key.
+        """
+        text = self.templates.get(key)
+        if text is None:
+            mark = len(self.chunks)
+            emit()
+            text = ''.join(self.chunks[mark:])
+            del self.chunks[mark:]
+            self.templates[key] = text
+        self.write(text)
+
     def setFile(self, fileName: str) -> None:
         self.vmName = fileName
 
@@ -75,7 +139,7 @@ M=D
         """
         stack[SP++] = D
         """
-        self.f.write("""\
+        self.write("""\
 @SP
 M=M+1
 A=M-1
@@ -86,22 +150,43 @@ M=D
         """
         D = stack[--SP]
         """
-        self.f.write("""\
+        self.write("""\
 @SP
 AM=M-1
 D=M
 """)
 
     def saveD(self, dst: str) -> None:
-        self.f.write(f"""\
+        self.write(f"""\
 @{dst}
 M=D
 """)
 
     def writeD(self, src: int | str) -> None:
-        self.f.write(f"""\
+        self.write(f"""\
 @{src}
 D={"A" if isinstance(src, int) else "M"}
+""")
+
+    def writeConstant(self, value: int) -> None:
+        """
+        D = value; negative values come from the optimizer's folding
+        """
+        if value >= 0:
+            self.writeD(value)
+        elif value == -1:
+            self.write("D=-1\n")
+        elif value == -0x8000:
+            # 32768 does not fit in an A-instruction
+            self.write("""\
+@32767
+D=-A
+D=D-1
+""")
+        else:
+            self.write(f"""\
+@{-value}
+D=-A
 """)
 
     def assign(self, src: int | str, dst: str) -> None:
@@ -116,10 +201,35 @@ D={"A" if isinstance(src, int) else "M"}
         self.popToD()
         self.saveD(dst)
 
+    def spill(self) -> None:
+        """
+        Put a cached top back on the stack in RAM
+        """
+        if self.cached:
+            self.pushFromD()
+            self.cached = False
+
+    def loadTop(self) -> None:
+        """
+        D = the top of the stack, which stays cached until consumed
+        """
+        if not self.cached:
+            self.popToD()
+            self.cached = True
+
+    def takeTop(self) -> None:
+        """
+        D = stack[--SP], or the cached top
+        """
+        if self.cached:
+            self.cached = False
+        else:
+            self.popToD()
+
     def selectSegment(self, segment: str, index: int) -> None:
         addr = BaseAddressLocation[segment]
         if isinstance(addr, type(lambda x: x)):
-            self.f.write(f"""\
+            self.write(f"""\
 @{addr(self.vmName, index)}
 D=A
 """)
@@ -127,21 +237,36 @@ D=A
             if isinstance(addr, int):
                 self.writeD(addr)
             else:
-                self.f.write(f"""\
+                self.write(f"""\
 @{addr}
 D=M
 """)
-            self.f.write(f"""\
+            self.write(f"""\
 @{index}
 AD=D+A
 """)
 
-    def pushFromSegment(self, segment: str, index: int) -> None:
+    def directAddress(self, segment: str, index: int) -> int | str | None:
+        """
+        The symbol or address of a segment entry known at translation time,
+        None for the segments based on a pointer.
+        """
+        addr = BaseAddressLocation[segment]
+        if isinstance(addr, type(lambda x: x)):
+            return addr(self.vmName, index)
+        if isinstance(addr, int):
+            return addr + index
+        return None
+
+    def segmentToD(self, segment: str, index: int) -> None:
         if segment == 'constant':
-            self.writeD(index)
+            self.writeConstant(index)
         else:
             self.selectSegment(segment, index)
-            self.f.write(f"D=M\n")
+            self.write(f"D=M\n")
+
+    def pushFromSegment(self, segment: str, index: int) -> None:
+        self.segmentToD(segment, index)
         self.pushFromD()
 
     def popToSegment(self, segment: str, index: int) -> None:
@@ -151,21 +276,21 @@ AD=D+A
         self.selectSegment(segment, index)
         self.saveD(TempVariable.R13)
         self.popToD()
-        self.f.write("""\
+        self.write("""\
 @R13
 A=M
 M=D
 """)
 
     def writeUnaryArithmetic(self, asmOp: str) -> None:
-        self.f.write(f"""\
+        self.write(f"""\
 @SP
 A=M-1
 M={asmOp}M
 """)
 
     def writeBinary(self, asmOp: str) -> None:
-        self.f.write(f"""\
+        self.write(f"""\
 @SP
 M=M-1
 A=M-1
@@ -176,15 +301,18 @@ D=D{asmOp}M
 
     def writeBinaryArithmetic(self, asmOp: str) -> None:
         self.writeBinary(asmOp)
-        self.f.write("""\
+        self.write("""\
 A=A-1
 M=D
 """)
 
     def writeCompare(self, asmOp: str) -> None:
+        if self.sharedCompares:
+            self.writeSharedCompare(asmOp)
+            return
         self.writeBinary(BinaryOperator['sub'])
         trueLabel, falseLabel = self.nextCmpLabel(asmOp)
-        self.f.write(f"""\
+        self.write(f"""\
 @{trueLabel}
 D;J{asmOp}
 @SP
@@ -199,48 +327,226 @@ M=-1
 ({falseLabel})
 """)
 
-    def writeArithmetic(self, command: str) -> None:
+    def compareStubLabel(self, asmOp: str) -> str:
+        return f'{WrapperFuncName}${asmOp}'
+
+    def writeSharedCompare(self, asmOp: str) -> None:
+        """
+        D = return address
+        """
+        self.compareStubs.add(asmOp)
+        retAddr, _ = self.nextCmpLabel(asmOp)
+        self.write(f"""\
+@{retAddr}
+D=A
+@{self.compareStubLabel(asmOp)}
+0;JMP
+({retAddr})
+""")
+
+    def writeCompareStub(self, asmOp: str) -> None:
+        """
+        Replaces the top two values with their comparison, occupies R13
+        """
+        label = self.compareStubLabel(asmOp)
+        self.write(f"""\
+({label})
+@R13
+M=D
+@SP
+AM=M-1
+D=M
+A=A-1
+D=M-D
+M=-1
+@{label}.TRUE
+D;J{asmOp}
+@SP
+A=M-1
+M=0
+({label}.TRUE)
+@R13
+A=M
+0;JMP
+""")
+
+    def writeTopArithmetic(self, command: str) -> None:
+        """
+        The operation on D and, for binary ones, RAM[--SP]
+        """
+        if command in CompareOperator and self.sharedCompares:
+            self.spill()
+            self.writeSharedCompare(command.upper())
+            return
+        self.loadTop()
         if command in UnaryOperator:
-            self.writeUnaryArithmetic(UnaryOperator[command])
+            self.write(f"D={UnaryOperator[command]}D\n")
+            return
+        self.write("""\
+@SP
+AM=M-1
+""")
+        if command == 'sub' or command in CompareOperator:
+            self.write("D=M-D\n")
+        else:
+            self.write(f"D=D{BinaryOperator[command]}M\n")
+        if command in CompareOperator:
+            trueLabel, falseLabel = self.nextCmpLabel(command.upper())
+            self.write(f"""\
+@{trueLabel}
+D;J{command.upper()}
+D=0
+@{falseLabel}
+0;JMP
+({trueLabel})
+D=-1
+({falseLabel})
+""")
+
+    def writeArithmetic(self, command: str) -> None:
+        if self.cacheTop:
+            self.writeTopArithmetic(command)
+        elif command in UnaryOperator:
+            self.writeCached((command,), lambda: self.writeUnaryArithmetic(UnaryOperator[command]))
         elif command in BinaryOperator:
-            self.writeBinaryArithmetic(BinaryOperator[command])
+            self.writeCached((command,), lambda: self.writeBinaryArithmetic(BinaryOperator[command]))
         else:
             self.writeCompare(command.upper())
 
+    def popTopToSegment(self, segment: str, index: int) -> None:
+        """
+        segment[index] = D. May occupy R13 and R14
+        """
+        dest = self.directAddress(segment, index)
+        if dest is not None:
+            self.saveD(dest)
+        elif index <= MaxAddressSteps:
+            self.write(f"""\
+@{BaseAddressLocation[segment]}
+A={"M+1" if index else "M"}
+""")
+            if index > 1:
+                self.write("A=A+1\n" * (index - 1))
+            self.write("M=D\n")
+        else:
+            self.saveD(TempVariable.R13)
+            self.selectSegment(segment, index)
+            self.saveD(TempVariable.R14)
+            self.writeD(TempVariable.R13)
+            self.write("""\
+@R14
+A=M
+M=D
+""")
+
     def writePushPop(self, command: CommandType, segment: str, index: int) -> None:
+        if self.cacheTop:
+            # The text depends on the cache state, so it is never reused
+            if command == CommandType.C_PUSH:
+                self.spill()
+                self.moveToD(segment, index)
+                self.cached = True
+            else:
+                self.takeTop()
+                self.popTopToSegment(segment, index)
+            return
+        # Statics are named after the file
+        key = (command, segment, index, self.vmName if segment == 'static' else None)
         if command == CommandType.C_PUSH:
-            self.pushFromSegment(segment, index)
+            self.writeCached(key, lambda: self.pushFromSegment(segment, index))
         else:
-            self.popToSegment(segment, index)
+            self.writeCached(key, lambda: self.popToSegment(segment, index))
+
+    def moveToD(self, segment: str, index: int) -> None:
+        src = None if segment == 'constant' else self.directAddress(segment, index)
+        if src is None:
+            self.segmentToD(segment, index)
+        else:
+            self.write(f"""\
+@{src}
+D=M
+""")
+
+    def moveSegment(self, segment: str, index: int, destSegment: str, destIndex: int) -> None:
+        """
+        occupy R13 if the destination is based on a pointer
+        """
+        dest = self.directAddress(destSegment, destIndex)
+        if dest is not None:
+            self.moveToD(segment, index)
+            self.saveD(dest)
+            return
+        self.selectSegment(destSegment, destIndex)
+        self.saveD(TempVariable.R13)
+        self.moveToD(segment, index)
+        self.write("""\
+@R13
+A=M
+M=D
+""")
+
+    def writeMove(self, segment: str, index: int, destSegment: str, destIndex: int) -> None:
+        """
+        push segment index; pop destSegment destIndex, without the stack
+        """
+        self.spill()
+        key = (CommandType.C_MOVE, segment, index, destSegment, destIndex,
+               self.vmName if 'static' in (segment, destSegment) else None)
+        self.writeCached(key, lambda: self.moveSegment(segment, index, destSegment, destIndex))
 
     def writeLabel(self, label: str) -> None:
-        self.f.write(f'({self.innerFuncLabel(label)})\n')
+        self.spill()
+        self.write(f'({self.innerFuncLabel(label)})\n')
 
     def writeGoto(self, label: str) -> None:
-        self.f.write(f"""\
+        self.spill()
+        self.write(f"""\
 @{self.innerFuncLabel(label)}
 0;JMP
 """)
 
     def writeIf(self, label: str) -> None:
-        self.popToD()
-        self.f.write(f"""\
+        self.takeTop()
+        self.write(f"""\
+@{self.innerFuncLabel(label)}
+D;JNE
+""")
+
+    def writeIfNot(self, label: str) -> None:
+        """
+        Jump unless the popped value is true (-1)
+        """
+        if self.cached:
+            self.cached = False
+            self.write("D=D+1\n")
+        else:
+            self.write("""\
+@SP
+AM=M-1
+D=M+1
+""")
+        self.write(f"""\
 @{self.innerFuncLabel(label)}
 D;JNE
 """)
 
     def writeFunction(self, functionName: str, nVars: int) -> None:
+        self.spill()
         self.setFunc(functionName)
 
-        self.f.write(f"({functionName})\n")
+        self.write(f"({functionName})\n")
         if nVars:
             self.writeD(0)
             for _ in range(nVars):
                 self.pushFromD()
 
     def writeCall(self, functionName: str, nArgs: int) -> None:
+        self.spill()
         retAddr = self.nextRetLabel()
-        self.f.write(f"""\
+        if self.sharedCalls:
+            self.writeSharedCall(functionName, nArgs, retAddr)
+            return
+        self.write(f"""\
 @{retAddr}
 D=A
 """)
@@ -249,7 +555,7 @@ D=A
         self.pushFromVar('ARG')
         self.pushFromVar('THIS')
         self.pushFromVar('THAT')
-        self.f.write(f"""\
+        self.write(f"""\
 @SP
 D=M
 @LCL
@@ -263,11 +569,89 @@ M=D
 @{functionName}
 0;JMP
 ({retAddr})
+""")
+
+    def callEntryLabel(self, functionName: str, nArgs: int) -> str:
+        return f'{CallStubLabel}.{functionName}.{nArgs}'
+
+    def writeSharedCall(self, functionName: str, nArgs: int, retAddr: str) -> None:
+        """
+        D = return address, the entry stub of the callee does the rest
+        """
+        self.callEntries.add((functionName, nArgs))
+        self.write(f"""\
+@{retAddr}
+D=A
+@{self.callEntryLabel(functionName, nArgs)}
+0;JMP
+({retAddr})
+""")
+
+    def writeCallEntry(self, functionName: str, nArgs: int) -> None:
+        """
+        Pushes the return address in D, then R13 = nArgs, R14 = function
+        for the call stub
+        """
+        self.write(f'({self.callEntryLabel(functionName, nArgs)})\n')
+        self.pushFromD()
+        if nArgs <= 1:
+            self.write(f"""\
+@R13
+M={nArgs}
+""")
+        else:
+            self.assign(nArgs, TempVariable.R13)
+        self.write(f"""\
+@{functionName}
+D=A
+@R14
+M=D
+@{CallStubLabel}
+0;JMP
+""")
+
+    def writeCallStub(self) -> None:
+        """
+        The return address is already pushed
+        """
+        self.write(f'({CallStubLabel})\n')
+        self.pushFromVar('LCL')
+        self.pushFromVar('ARG')
+        self.pushFromVar('THIS')
+        self.pushFromVar('THAT')
+        self.write("""\
+@SP
+D=M
+@LCL
+M=D
+@R13
+D=D-M
+@5
+D=D-A
+@ARG
+M=D
+@R14
+A=M
+0;JMP
 """)
 
     def writeReturn(self) -> None:
+        top = self.cached
+        self.cached = False
+        if self.sharedCalls:
+            self.write(f"""\
+@{ReturnTopStubLabel if top else ReturnStubLabel}
+0;JMP
+""")
+        else:
+            self.writeReturnFrame(top)
+
+    def writeReturnFrame(self, top: bool = False) -> None:
+        """
+        top: the return value is in D
+        """
         # The textbook's approach
-        #         self.f.write(f"""\
+        #         self.write(f"""\
         # // frame = LCL
         # @LCL
         # D=M
@@ -282,7 +666,7 @@ M=D
         # // *ARG = pop()
         # """)
         #         self.popToD()
-        #         self.f.write(f"""\
+        #         self.write(f"""\
         # @ARG
         # A=M
         # M=D
@@ -328,7 +712,9 @@ M=D
 
         # Personal approach
         # Save ret val, not writing to *ARG directly, cause the caller's ret addr can be overwritten
-        self.popToVar(TempVariable.R13)
+        if not top:
+            self.popToD()
+        self.saveD(TempVariable.R13)
         # Save the pos of ARG, cause it will restore to the caller's
         self.assign('ARG', TempVariable.R14)
         # Let SP be align to LCL
@@ -342,13 +728,13 @@ M=D
         self.popToVar(TempVariable.R15)
         # Restore SP
         self.writeD(TempVariable.R14)
-        self.f.write(f"""\
+        self.write(f"""\
 @SP
 M=D+1
 """)
         # Write ret val to *ARG and jump to the caller
         self.writeD(TempVariable.R13)
-        self.f.write(f"""\
+        self.write(f"""\
 @R14
 A=M
 M=D
@@ -358,12 +744,38 @@ A=M
 """)
 
     def writeInfiniteLoop(self) -> None:
+        self.spill()
         self.setFunc(WrapperFuncName)
-        self.f.write(f"""\
+        self.write(f"""\
 ({self.innerFuncLabel('END')})
 @{self.innerFuncLabel('END')}
 0;JMP
 """)
 
+    def writeStubs(self) -> None:
+        """
+        Only reached by jumps. No function label is written here: it would
+        share its address with the first stub and turn the jumps into calls.
+        """
+        if self.sharedCalls:
+            # In a stable order
+            for functionName, nArgs in sorted(self.callEntries):
+                self.writeCallEntry(functionName, nArgs)
+            self.writeCallStub()
+            self.write(f'({ReturnStubLabel})\n')
+            if self.cacheTop:
+                self.popToD()
+                self.write(f'({ReturnTopStubLabel})\n')
+                self.writeReturnFrame(top=True)
+            else:
+                self.writeReturnFrame()
+        # Only the comparisons in use, in a stable order
+        for asmOp in sorted(self.compareStubs):
+            self.writeCompareStub(asmOp)
+
     def close(self) -> None:
+        self.spill()
+        if self.sharedCalls or self.compareStubs:
+            self.writeStubs()
+        self.flush()
         self.f.close()
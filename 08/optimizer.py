@@ -0,0 +1,147 @@
+"""
+Optimization passes over the commands of one function, between Parser and
+CodeWriter. Every pass takes and returns a list of Commands; optimize runs
+them over each function until nothing changes.
+"""
+from parser import Command, CommandType
+
+UnaryFolds = {
+    'neg': lambda x: -x,
+    'not': lambda x: ~x
+}
+BinaryFolds = {
+    'add': lambda x, y: x + y,
+    'sub': lambda x, y: x - y,
+    'and': lambda x, y: x & y,
+    'or': lambda x, y: x | y,
+    # Compared the way CodeWriter does, by the sign of the wrapped x - y
+    'eq': lambda x, y: -(toWord(x - y) == 0),
+    'gt': lambda x, y: -(toWord(x - y) > 0),
+    'lt': lambda x, y: -(toWord(x - y) < 0)
+}
+Jumps = {CommandType.C_GOTO, CommandType.C_IF, CommandType.C_IF_NOT}
+
+
+def toWord(value: int) -> int:
+    """
+    Wrap around to a signed 16-bit value, as the ALU does.
+    """
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+def pushConstant(value: int) -> Command:
+    return Command(CommandType.C_PUSH, 'constant', toWord(value))
+
+
+def isConstant(command: Command) -> bool:
+    return command.type == CommandType.C_PUSH and command.arg1 == 'constant'
+
+
+def isNot(command: Command) -> bool:
+    return command.type == CommandType.C_ARITHMETIC and command.arg1 == 'not'
+
+
+def foldConstants(commands: list[Command]) -> list[Command]:
+    """
+    Arithmetic on constants, and if-goto on a constant.
+    """
+    out = []
+    for command in commands:
+        if command.type == CommandType.C_ARITHMETIC:
+            op = command.arg1
+            if op in UnaryFolds and out and isConstant(out[-1]):
+                out[-1] = pushConstant(UnaryFolds[op](out[-1].arg2))
+                continue
+            if op in BinaryFolds and len(out) > 1 and isConstant(out[-1]) and isConstant(out[-2]):
+                y = out.pop().arg2
+                out[-1] = pushConstant(BinaryFolds[op](out[-1].arg2, y))
+                continue
+        elif command.type == CommandType.C_IF and out and isConstant(out[-1]):
+            if out.pop().arg2:
+                out.append(Command(CommandType.C_GOTO, command.arg1))
+            continue
+        out.append(command)
+    return out
+
+
+def fuseMoves(commands: list[Command]) -> list[Command]:
+    """
+    push X; pop Y -> move, Y = X without going through the stack.
+    """
+    out = []
+    for command in commands:
+        if command.type == CommandType.C_POP and out and out[-1].type == CommandType.C_PUSH:
+            push = out.pop()
+            out.append(Command(CommandType.C_MOVE, push.arg1, push.arg2, (command.arg1, command.arg2)))
+        else:
+            out.append(command)
+    return out
+
+
+def invertBranches(commands: list[Command]) -> list[Command]:
+    """
+    not; if-goto L -> if-not L, jumping unless the value is true (-1).
+    Exact for any value, Jack's booleans or not.
+    """
+    inverse = {CommandType.C_IF: CommandType.C_IF_NOT, CommandType.C_IF_NOT: CommandType.C_IF}
+    out = []
+    for command in commands:
+        if command.type in inverse and out and isNot(out[-1]):
+            out[-1] = Command(inverse[command.type], command.arg1)
+        else:
+            out.append(command)
+    return out
+
+
+def removeDeadCode(commands: list[Command]) -> list[Command]:
+    """
+    Drops labels nothing jumps to, the commands after a goto or return up to
+    the next label still jumped to, and gotos to the very next command.
+    """
+    targets = {command.arg1 for command in commands if command.type in Jumps}
+    out = []
+    reachable = True
+    for command in commands:
+        if command.type == CommandType.C_LABEL:
+            if command.arg1 not in targets:
+                continue
+            reachable = True
+            if out and out[-1].type == CommandType.C_GOTO and out[-1].arg1 == command.arg1:
+                out.pop()
+        elif command.type == CommandType.C_FUNCTION:
+            reachable = True
+        if reachable:
+            out.append(command)
+            if command.type in (CommandType.C_GOTO, CommandType.C_RETURN):
+                reachable = False
+    return out
+
+
+Passes = (removeDeadCode, foldConstants, invertBranches, fuseMoves)
+
+
+def splitFunctions(commands: list[Command]) -> list[list[Command]]:
+    """
+    Labels are local to functions, so each one is optimized on its own.
+    Commands before the first function come first.
+    """
+    functions = [[]]
+    for command in commands:
+        if command.type == CommandType.C_FUNCTION:
+            functions.append([])
+        functions[-1].append(command)
+    return functions
+
+
+def optimizeFunction(commands: list[Command]) -> list[Command]:
+    while True:
+        optimized = commands
+        for optimizationPass in Passes:
+            optimized = optimizationPass(optimized)
+        if optimized == commands:
+            return optimized
+        commands = optimized
+
+
+def optimize(commands: list[Command]) -> list[Command]:
+    return [command for function in splitFunctions(commands) for command in optimizeFunction(function)]
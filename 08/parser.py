@@ -1,6 +1,6 @@
 from enum import Enum
 from pathlib import Path
-from typing import Self
+from typing import NamedTuple, Self
 
 
 class CommandType(Enum):
@@ -13,6 +13,42 @@ class CommandType(Enum):
     C_FUNCTION = 7
     C_RETURN = 8
     C_CALL = 9
+    # Only built by the optimizer
+    C_MOVE = 10
+    C_IF_NOT = 11
+
+
+Keywords = {
+    CommandType.C_PUSH: 'push',
+    CommandType.C_POP: 'pop',
+    CommandType.C_LABEL: 'label',
+    CommandType.C_GOTO: 'goto',
+    CommandType.C_IF: 'if-goto',
+    CommandType.C_FUNCTION: 'function',
+    CommandType.C_CALL: 'call',
+    CommandType.C_RETURN: 'return',
+    CommandType.C_IF_NOT: 'if-not'
+}
+
+
+class Command(NamedTuple):
+    """
+    A parsed command, the unit the optimizer works on.
+    arg1 is the operator of an arithmetic command.
+    """
+    type: CommandType
+    arg1: str | None = None
+    arg2: int | None = None
+    # C_MOVE: segment and index of the pop
+    dest: tuple[str, int] | None = None
+
+    def __str__(self) -> str:
+        if self.type == CommandType.C_ARITHMETIC:
+            return self.arg1
+        if self.type == CommandType.C_MOVE:
+            return f'push {self.arg1} {self.arg2}; pop {self.dest[0]} {self.dest[1]}'
+        args = [str(arg) for arg in (self.arg1, self.arg2) if arg is not None]
+        return ' '.join([Keywords[self.type], *args])
 
 
 class Parser:
@@ -67,5 +103,20 @@ class Parser:
     def arg2(self) -> int:
         return int(self.cur_cmd[2])
 
+    def command(self) -> Command:
+        cmd = self.commandType()
+        if cmd == CommandType.C_RETURN:
+            return Command(cmd)
+        if cmd in (CommandType.C_PUSH, CommandType.C_POP, CommandType.C_FUNCTION, CommandType.C_CALL):
+            return Command(cmd, self.arg1(), self.arg2())
+        return Command(cmd, self.arg1())
+
+    def commands(self) -> list[Command]:
+        commands = []
+        while self.hasMoreLines():
+            self.advance()
+            commands.append(self.command())
+        return commands
+
     def close(self) -> None:
         self.f.close()
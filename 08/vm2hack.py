@@ -0,0 +1,47 @@
+# usage: python vm2hack.py <file.vm | folder> [boot] [--binary]
+#                           [--shared-calls] [--shared-compares] [--optimize]
+#                           [--cache-top]
+#   boot: any argument that is not an option writes the bootstrap code.
+#   Translates and assembles in memory: the code writer streams straight
+#   into the assembler from 06, no .asm file is written.
+from pathlib import Path
+import sys
+
+from vmtranslator import VMTranslator
+
+# 05/hackasm.py imports the assembler from 06 without its parser.py
+# replacing ours
+sys.path.append(str(Path(__file__).resolve().parent.parent.joinpath('05')))
+from hackasm import assembler  # noqa: E402
+
+
+def vmToStream(vm: str, bootstrap: bool, **options):
+    """
+    The finished StreamAssembler, for callers that need its labels too.
+    options go to VMTranslator, e.g. sharedCalls=True.
+    """
+    stream = assembler.StreamAssembler()
+    VMTranslator(vm, bootstrap, stream, **options)
+    return stream
+
+
+def vmToHack(vm: str, bootstrap: bool, **options):
+    return vmToStream(vm, bootstrap, **options).words
+
+
+if __name__ == '__main__':
+    vm = Path(sys.argv[1])
+    # As in vmtranslator.py, any argument that is not an option means boot
+    bootstrap = any(not option.startswith('--') for option in sys.argv[2:])
+    words = vmToHack(vm, bootstrap,
+                     sharedCalls='--shared-calls' in sys.argv[2:],
+                     sharedCompares='--shared-compares' in sys.argv[2:],
+                     optimize='--optimize' in sys.argv[2:],
+                     cacheTop='--cache-top' in sys.argv[2:])
+    binary = '--binary' in sys.argv[2:]
+    folder = vm.parent if vm.is_file() else vm
+    dest = folder.joinpath(f'{vm.stem}{".bin" if binary else ".hack"}')
+    if binary:
+        assembler.writeBinary(words, dest)
+    else:
+        assembler.writeText(words, dest)
@@ -0,0 +1,243 @@
+# usage: python testfarm.py [XTest folder ...] [--jobs N] [--jit]
+#                           [--cycles N] [--screens DIR] [--shared-calls]
+#                           [--shared-compares] [--optimize] [--cache-top]
+#   Runs the OS tests without the Java tools: every *Test folder here (and
+#   folders inside one with their own Main.jack, e.g. MemoryTest/MemoryDiag)
+#   is compiled by 11/JackCompiler together with the OS classes of this
+#   folder, translated and assembled in memory by 08/vm2hack.py, and run on
+#   05/emulator.py until Sys.halt. A test with a .tst script is then checked
+#   against its .cmp, the others pass by reaching Sys.halt; --screens saves
+#   their final screens to compare with the expected pictures.
+#   A test that reads the keyboard is fed the key trace XTest.keys in its
+#   folder through 05/replay.py, and is unsupported without one.
+#   Functions Sys.init never reaches are left out. Translated plainly, the
+#   tests using Output still do not fit in the 32K ROM and are unsupported;
+#   the translator options of 08/vmtranslator.py make them fit.
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+OSFolder = Path(__file__).resolve().parent
+for folder in ('11/JackCompiler', '08', '05'):
+    sys.path.append(str(OSFolder.parent.joinpath(folder)))
+
+from jack_compiler import JackCompiler  # noqa: E402
+from vm2hack import vmToStream  # noqa: E402
+from emulator import Emulator, StopReason  # noqa: E402
+from jit import JitEmulator  # noqa: E402
+from screen import ScreenRenderer  # noqa: E402
+from tstrunner import EmulatorTarget, Status, TestScript  # noqa: E402
+from replay import readTrace, replay  # noqa: E402
+
+# Generous: ScreenTest alone takes 370M cycles translated plainly, and
+# a test fed a key trace runs at least until its last key
+MAX_CYCLES = 1000000000
+HALT_FUNCTION = 'Sys.halt'
+ERROR_FUNCTION = 'Sys.error'
+ENTRY_FUNCTION = 'Sys.init'
+# How 06/assembler.py refuses a label past the end of the 32K ROM
+ROM_OVERFLOW = 'does not fit in an A-instruction'
+
+
+def osClasses():
+    return {p.stem: p for p in OSFolder.glob('*.jack')}
+
+
+def findTests(folders=None):
+    """
+    Test folders: the given ones, or every *Test folder and the folders
+    below it that have a Main.jack.
+    """
+    if folders:
+        return [Path(folder) for folder in folders]
+    tests = []
+    for folder in sorted(OSFolder.glob('*Test')):
+        tests.extend(sorted(main.parent for main in folder.rglob('Main.jack')))
+    return tests
+
+
+def testSources(testFolder):
+    """
+    The test's own classes; copies of OS classes are left out.
+    """
+    classes = osClasses()
+    return [jackFilePath for jackFilePath in testFolder.glob('*.jack')
+            if jackFilePath.stem not in classes]
+
+
+def readsKeyboard(testFolder):
+    return any('Keyboard.' in jackFilePath.read_text()
+               for jackFilePath in testSources(testFolder))
+
+
+def vmFunctions(vmFilePath):
+    """
+    (function, lines of its commands, called functions) per function of a
+    .vm file, comments and blank lines left out.
+    """
+    functions = []
+    with vmFilePath.open() as src:
+        for line in src:
+            line = line.split('//')[0].strip()
+            if not line:
+                continue
+            words = line.split()
+            if words[0] == 'function':
+                functions.append((words[1], [], set()))
+            elif words[0] == 'call':
+                functions[-1][2].add(words[1])
+            functions[-1][1].append(line)
+    return functions
+
+
+def pruneUnreachable(vmFolder):
+    """
+    Drop the functions Sys.init never calls, directly or not, from the
+    .vm files of vmFolder, so that more tests fit in the ROM.
+    """
+    files = {vmFilePath: vmFunctions(vmFilePath)
+             for vmFilePath in vmFolder.glob('*.vm')}
+    calls = {function: called for functions in files.values()
+             for function, _, called in functions}
+    reachable = set()
+    pending = [ENTRY_FUNCTION]
+    while pending:
+        function = pending.pop()
+        if function not in reachable and function in calls:
+            reachable.add(function)
+            pending.extend(calls[function])
+    for vmFilePath, functions in files.items():
+        lines = [line for function, body, _ in functions
+                 if function in reachable for line in body]
+        if lines:
+            vmFilePath.write_text('\n'.join(lines) + '\n')
+        else:
+            vmFilePath.unlink()
+
+
+def compileTest(testFolder, **options):
+    """
+    The assembled test program, a finished StreamAssembler. The OS classes
+    always come from this folder, so the copies the .bat scripts leave in
+    the test folders never go stale. options go to the VM translator.
+    """
+    classes = osClasses()
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = Path(tmp)
+        for jackFilePath in testSources(testFolder):
+            shutil.copy(jackFilePath, sources)
+        for jackFilePath in classes.values():
+            shutil.copy(jackFilePath, sources)
+        JackCompiler(sources)
+        pruneUnreachable(sources.joinpath('build'))
+        return vmToStream(sources.joinpath('build'), True, **options)
+
+
+def runTest(testFolder, maxCycles=MAX_CYCLES, jit=False, screens=None,
+            translatorOptions=None):
+    """
+    Batch worker, returns (folder, Status, message, cycles, seconds)
+    instead of raising.
+    """
+    start = time.perf_counter()
+    cycles = None
+    try:
+        traceFilePath = testFolder.joinpath(f'{testFolder.name}.keys')
+        if not traceFilePath.exists() and readsKeyboard(testFolder):
+            return (testFolder, Status.UNSUPPORTED,
+                    f'reads the keyboard, no {traceFilePath.name} trace',
+                    None, time.perf_counter() - start)
+
+        try:
+            stream = compileTest(testFolder, **(translatorOptions or {}))
+        except ValueError as e:
+            if ROM_OVERFLOW not in str(e):
+                raise
+            return (testFolder, Status.UNSUPPORTED,
+                    f'does not fit in the ROM: {e}',
+                    None, time.perf_counter() - start)
+        emulator = (JitEmulator if jit else Emulator)(stream.words)
+        for function in (HALT_FUNCTION, ERROR_FUNCTION):
+            if function in stream.labels:
+                emulator.addBreakpoint(stream.labels[function])
+        if traceFilePath.exists():
+            reason = replay(emulator, readTrace(traceFilePath), maxCycles)
+        else:
+            reason = emulator.run(maxCycles)
+        cycles = emulator.cycles
+
+        if screens is not None:
+            renderer = ScreenRenderer(emulator.ram)
+            renderer.render()
+            renderer.save(Path(screens).joinpath(f'{testFolder.name}.png'))
+
+        if reason != StopReason.BREAKPOINT:
+            status, message = Status.FAILED, f'{reason} before Sys.halt'
+        elif emulator.pc == stream.labels[HALT_FUNCTION]:
+            status, message = Status.PASSED, 'reached Sys.halt'
+            for tstFilePath in sorted(testFolder.glob('*.tst')):
+                status, message = TestScript(
+                    tstFilePath, writeOutput=False,
+                    target=EmulatorTarget(emulator)).run()
+        else:
+            # Entering Sys.error, its argument is the error code
+            ram = emulator.ram
+            status, message = Status.FAILED, f'Sys.error({ram[ram[2]]})'
+    except Exception as e:
+        status, message = Status.ERROR, f'{type(e).__name__}: {e}'
+    return testFolder, status, message, cycles, time.perf_counter() - start
+
+
+def runTests(testFolders, workers=None, **options):
+    """
+    Run every test across a process pool, results in folder order.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(runTest, folder, **options)
+                   for folder in testFolders]
+        for future in as_completed(futures):
+            results.append(future.result())
+    return sorted(results, key=lambda result: result[0])
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Run the 12/ OS tests.')
+    argParser.add_argument('tests', nargs='*')
+    argParser.add_argument('--jobs', type=int, default=None)
+    argParser.add_argument('--jit', action='store_true')
+    argParser.add_argument('--cycles', type=int, default=MAX_CYCLES,
+                           help='give up on a test after this many cycles')
+    argParser.add_argument('--screens',
+                           help='save every final screen in this folder')
+    argParser.add_argument('--shared-calls', action='store_true',
+                           help='see 08/vmtranslator.py')
+    argParser.add_argument('--shared-compares', action='store_true')
+    argParser.add_argument('--optimize', action='store_true')
+    argParser.add_argument('--cache-top', action='store_true')
+    args = argParser.parse_args()
+    if args.screens:
+        Path(args.screens).mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    results = runTests(findTests(args.tests), args.jobs, maxCycles=args.cycles,
+                       jit=args.jit, screens=args.screens,
+                       translatorOptions=dict(
+                           sharedCalls=args.shared_calls,
+                           sharedCompares=args.shared_compares,
+                           optimize=args.optimize, cacheTop=args.cache_top))
+    counts = {status: 0 for status in Status}
+    for testFolder, status, message, cycles, seconds in results:
+        counts[status] += 1
+        print(f'{status.upper():12} {"" if cycles is None else cycles:>11} '
+              f'cycles {seconds:7.2f} s  {testFolder}')
+        if status != Status.PASSED:
+            print(f'    {message}')
+
+    print(', '.join(f'{n} {status}' for status, n in counts.items() if n) +
+          f' in {time.perf_counter() - start:.2f}s')
+    sys.exit(counts[Status.FAILED] + counts[Status.ERROR] > 0)